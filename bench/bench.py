@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+
+"""
+    Throughput benchmarks of the plugins of this repository.
+
+    Synthetic inputs of the requested size are generated in a work directory,
+    then each benchmark runs a babeltrace2 graph on them and measures its wall
+    time and peak RSS. The same graph is also run on a one-event input to
+    measure the startup time, which is subtracted from the wall time when
+    computing the number of events per second.
+
+    Results are printed and written as JSON, see README.md.
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CAN_DATABASE = os.path.join(ROOT, "can", "database.dbc")
+
+# Same record as the CAN plugins: timestamp (ms), frame ID and 8 data bytes.
+CAN_RECORD = struct.Struct("<ii8s")
+
+# Ratio of CAN frames whose ID isn't in the database.
+CAN_UNKNOWN_RATIO = 0.01
+
+# CAN frames received per millisecond.
+CAN_FRAMES_PER_MS = 10
+
+# Ratio of GPX points written as waypoints rather than track points.
+GPX_WAYPOINT_RATIO = 0.01
+
+CTF_METADATA = """/* CTF 1.8 */
+
+typealias integer { size = 32; align = 8; signed = false; } := uint32_t;
+typealias integer { size = 64; align = 8; signed = false; } := uint64_t;
+
+trace {
+	major = 1;
+	minor = 8;
+	byte_order = le;
+	packet.header := struct {
+		uint32_t magic;
+		uint32_t stream_id;
+	};
+};
+
+clock {
+	name = "monotonic";
+	freq = 1000000000;
+};
+
+typealias integer {
+	size = 64; align = 8; signed = false;
+	map = clock.monotonic.value;
+} := uint64_clock_monotonic_t;
+
+stream {
+	id = 0;
+	packet.context := struct {
+		uint64_clock_monotonic_t timestamp_begin;
+		uint64_clock_monotonic_t timestamp_end;
+		uint64_t content_size;
+		uint64_t packet_size;
+	};
+	event.header := struct {
+		uint64_clock_monotonic_t timestamp;
+		uint32_t id;
+	};
+};
+
+event {
+	name = "math:cos";
+	id = 0;
+	stream_id = 0;
+	fields := struct {
+		floating_point { exp_dig = 11; mant_dig = 53; align = 8; } _value;
+	};
+};
+
+event {
+	name = "math:sin";
+	id = 1;
+	stream_id = 0;
+	fields := struct {
+		floating_point { exp_dig = 11; mant_dig = 53; align = 8; } _value;
+	};
+};
+"""
+
+# Packet header and context of the CTF streams, see `CTF_METADATA`.
+CTF_MAGIC = 0xC1FC1FC1
+CTF_PACKET_HEADER = struct.Struct("<IIQQQQ")
+CTF_PACKET_SIZE = 65536
+
+# Event header and payload, the payload being aligned on 8 bytes.
+CTF_EVENT = struct.Struct("<QI4xd")
+
+# Nanoseconds between two CTF events.
+CTF_EVENT_PERIOD = 1000
+
+
+def _set_raw_signal(data, signal, raw):
+    # Set the raw value of `signal` (a cantools signal) in 8 bytes of data,
+    # with the same bit numbering as the decoders of the CAN plugin.
+    if signal.byte_order == "little_endian":
+        order = "little"
+        shift = signal.start
+    else:
+        order = "big"
+        msb = 8 * (signal.start // 8) + 7 - signal.start % 8
+        shift = 64 - msb - signal.length
+
+    mask = (1 << signal.length) - 1
+    value = int.from_bytes(data, order)
+    value = (value & ~(mask << shift)) | ((raw & mask) << shift)
+
+    return value.to_bytes(8, order)
+
+
+def generate_can(path, count, rng):
+    """
+        Writes `count` CAN frames of the messages of the example database,
+        including multiplexed ones and a few unknown frame IDs, with random
+        data. Returns the number of events the CAN source emits for it.
+    """
+    import cantools
+
+    database = cantools.database.load_file(CAN_DATABASE)
+
+    # The multiplexer of multiplexed messages must have a known value, or the
+    # frame can't be decoded.
+    frames = []
+    for message in database.messages:
+        multiplexers = [node for node in message.signal_tree if isinstance(node, dict)]
+        if len(multiplexers) == 0:
+            frames.append((message.frame_id, None, None))
+            continue
+
+        for (name, values) in multiplexers[0].items():
+            signal = message.get_signal_by_name(name)
+            frames.append((message.frame_id, signal, sorted(values.keys())))
+
+    unknown_id = max(message.frame_id for message in database.messages) + 1
+
+    with open(path, "wb") as f:
+        for i in range(count):
+            data = rng.randbytes(8)
+            if rng.random() < CAN_UNKNOWN_RATIO:
+                frame_id = unknown_id
+            else:
+                (frame_id, signal, values) = rng.choice(frames)
+                if signal is not None:
+                    data = _set_raw_signal(data, signal, rng.choice(values))
+
+            f.write(CAN_RECORD.pack(i // CAN_FRAMES_PER_MS, frame_id, data))
+
+    return count
+
+
+def _gpx_point(tag, i, name=None):
+    # A point going around the world along the equator, one per second.
+    lat = 10 * math.sin(i / 1000)
+    lon = (i / 100) % 360 - 180
+    seconds = 1577836800 + i
+    timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+
+    point = f'<{tag} lat="{lat:.7f}" lon="{lon:.7f}"><ele>{i % 1000}.5</ele>'
+    point += f"<time>{timestamp}</time>"
+    if name is not None:
+        point += f"<name>{name}</name>"
+
+    return point + f"</{tag}>\n"
+
+
+def generate_gpx(path, count, rng):
+    """
+        Writes a GPX file of `count` points: waypoints, then a single track
+        segment. Returns the number of events the GPX source emits for it.
+    """
+    waypoints = int(count * GPX_WAYPOINT_RATIO)
+
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write(
+            '<gpx version="1.1" creator="bench" '
+            'xmlns="http://www.topografix.com/GPX/1/1">\n'
+        )
+
+        for i in range(waypoints):
+            f.write(_gpx_point("wpt", rng.randrange(count), f"Waypoint {i}"))
+
+        f.write("<trk><name>Track</name><trkseg>\n")
+        for i in range(count - waypoints):
+            f.write(_gpx_point("trkpt", i))
+        f.write("</trkseg></trk>\n</gpx>\n")
+
+    return count
+
+
+def generate_ctf(path, count, rng):
+    """
+        Writes a CTF trace of `count` `math:cos` and `math:sin` events with
+        a `value` field, in a single stream. Returns the number of events.
+    """
+    os.makedirs(path, exist_ok=True)
+
+    with open(os.path.join(path, "metadata"), "w") as f:
+        f.write(CTF_METADATA)
+
+    per_packet = (CTF_PACKET_SIZE - CTF_PACKET_HEADER.size) // CTF_EVENT.size
+
+    with open(os.path.join(path, "stream_0"), "wb") as f:
+        for first in range(0, count, per_packet):
+            events = bytearray()
+            for i in range(first, min(first + per_packet, count)):
+                event_id = rng.randrange(2)
+                value = math.cos(i / 1000) if event_id == 0 else math.sin(i / 1000)
+                events += CTF_EVENT.pack(i * CTF_EVENT_PERIOD, event_id, value)
+
+            last = first + len(events) // CTF_EVENT.size - 1
+            f.write(
+                CTF_PACKET_HEADER.pack(
+                    CTF_MAGIC,
+                    0,
+                    first * CTF_EVENT_PERIOD,
+                    last * CTF_EVENT_PERIOD,
+                    8 * (CTF_PACKET_HEADER.size + len(events)),
+                    8 * CTF_PACKET_SIZE,
+                )
+            )
+            f.write(events)
+            f.write(bytes(CTF_PACKET_SIZE - CTF_PACKET_HEADER.size - len(events)))
+
+    return count
+
+
+def _can_args(plugin_dir):
+    def _args(path):
+        return [
+            "--plugin-path",
+            os.path.join(ROOT, "can", plugin_dir),
+            "-c",
+            "source.can.CANSource",
+            "--params",
+            f'inputs=["{path}"],databases=["{CAN_DATABASE}"]',
+            "-c",
+            "sink.utils.dummy",
+        ]
+
+    return _args
+
+
+def _gpx_args(path):
+    return [
+        "--plugin-path",
+        os.path.join(ROOT, "gpx"),
+        "-c",
+        "source.gpx.GpxSource",
+        "--params",
+        f'inputs=["{path}"]',
+        "-c",
+        "sink.utils.dummy",
+    ]
+
+
+def _plot_args(path):
+    data = [
+        '["timed", "cos", "math:cos", "value"]',
+        '["timed", "sin", "math:sin", "value"]',
+        '["interpolated", "curve", "math:cos", "value", "math:sin", "value"]',
+    ]
+    plots = [
+        f'["Timed", "t", "y", [{data[0]}, {data[1]}]]',
+        f'["Curve", "x", "y", [{data[2]}]]',
+    ]
+
+    return [
+        "--plugin-path",
+        os.path.join(ROOT, "plot"),
+        "-c",
+        "sink.plot.PlotSink",
+        "--params",
+        f"plots=[{', '.join(plots)}]",
+        path,
+    ]
+
+
+def _can_c_available():
+    return any(
+        name.endswith(".so") for name in os.listdir(os.path.join(ROOT, "can", "c"))
+    )
+
+
+# Name, input generator, input file name, babeltrace2 arguments for an input
+# and whether the benchmark can run.
+BENCHMARKS = [
+    ("can-python", generate_can, "can.data", _can_args("python"), lambda: True),
+    ("can-c", generate_can, "can.data", _can_args("c"), _can_c_available),
+    ("gpx", generate_gpx, "trace.gpx", _gpx_args, lambda: True),
+    ("plot", generate_ctf, "ctf", _plot_args, lambda: True),
+]
+
+
+def run_graph(babeltrace2, args, cwd):
+    """
+        Runs babeltrace2 with `args` and returns its wall time (s) and peak
+        RSS (KiB).
+    """
+    start = time.monotonic()
+    process = subprocess.Popen([babeltrace2] + args, cwd=cwd, stdout=subprocess.DEVNULL)
+    (pid, status, rusage) = os.wait4(process.pid, 0)
+    wall_time = time.monotonic() - start
+
+    # Let `Popen` know the process is gone.
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(
+            f"babeltrace2 {' '.join(args)} exited with {process.returncode}"
+        )
+
+    return (wall_time, rusage.ru_maxrss)
+
+
+def run_benchmark(
+    babeltrace2, work_dir, name, generate, input_name, args, events, repeat, seed
+):
+    # Each benchmark gets its own directory, as the plugins may write files
+    # (indexes, plots) next to their inputs or in the current directory.
+    bench_dir = os.path.join(work_dir, name)
+    os.makedirs(bench_dir, exist_ok=True)
+
+    startup_path = os.path.join(bench_dir, f"startup-{input_name}")
+    generate(startup_path, 1, random.Random(seed))
+
+    path = os.path.join(bench_dir, input_name)
+    start = time.monotonic()
+    events = generate(path, events, random.Random(seed))
+    generate_time = time.monotonic() - start
+
+    # The best of `repeat` runs is kept, being the least disturbed one.
+    startup_time = min(
+        run_graph(babeltrace2, args(startup_path), bench_dir)[0] for i in range(repeat)
+    )
+    runs = [run_graph(babeltrace2, args(path), bench_dir) for i in range(repeat)]
+    wall_time = min(run[0] for run in runs)
+    peak_rss = max(run[1] for run in runs)
+
+    # Too small inputs are processed within the noise of the startup time.
+    processing_time = wall_time - startup_time
+    if processing_time > 0:
+        events_per_second = events / processing_time
+    else:
+        events_per_second = None
+
+    return {
+        "name": name,
+        "events": events,
+        "generate_time": generate_time,
+        "startup_time": startup_time,
+        "wall_time": wall_time,
+        "events_per_second": events_per_second,
+        "peak_rss_kib": peak_rss,
+    }
+
+
+def _babeltrace2_version(babeltrace2):
+    output = subprocess.run(
+        [babeltrace2, "--version"], stdout=subprocess.PIPE, universal_newlines=True
+    ).stdout
+
+    return output.splitlines()[0] if output else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        metavar="BENCHMARK",
+        help="benchmarks to run (default: all): "
+        + ", ".join(benchmark[0] for benchmark in BENCHMARKS),
+    )
+    parser.add_argument(
+        "--events",
+        type=int,
+        default=1000000,
+        help="events per input (default: 1000000)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="runs per benchmark (default: 3)"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="seed of the input generators"
+    )
+    parser.add_argument(
+        "--babeltrace2",
+        default=os.environ.get("BABELTRACE2", "babeltrace2"),
+        help="babeltrace2 executable (default: $BABELTRACE2 or babeltrace2)",
+    )
+    parser.add_argument(
+        "--work-dir", help="keep the generated inputs in this directory"
+    )
+    parser.add_argument(
+        "--output",
+        default="bench-results.json",
+        help="JSON results file (default: bench-results.json)",
+    )
+    args = parser.parse_args()
+
+    names = [benchmark[0] for benchmark in BENCHMARKS]
+    for name in args.benchmarks:
+        if name not in names:
+            parser.error(f"unknown benchmark `{name}`")
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bt-fun-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+
+    results = []
+    try:
+        for (name, generate, input_name, graph_args, available) in BENCHMARKS:
+            if args.benchmarks and name not in args.benchmarks:
+                continue
+
+            if not available():
+                print(f"{name}: skipped", file=sys.stderr)
+                results.append({"name": name, "skipped": True})
+                continue
+
+            result = run_benchmark(
+                args.babeltrace2,
+                work_dir,
+                name,
+                generate,
+                input_name,
+                graph_args,
+                args.events,
+                args.repeat,
+                args.seed,
+            )
+            results.append(result)
+            if result["events_per_second"] is None:
+                rate = "too few events to measure"
+            else:
+                rate = f"{result['events_per_second']:.0f} events/s"
+
+            print(
+                f"{name}: {rate}, "
+                f"startup {result['startup_time']:.3f} s, "
+                f"peak RSS {result['peak_rss_kib'] / 1024:.1f} MiB",
+                file=sys.stderr,
+            )
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "babeltrace2": _babeltrace2_version(args.babeltrace2),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+                "events": args.events,
+                "repeat": args.repeat,
+                "results": results,
+            },
+            f,
+            indent=4,
+        )
+        f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
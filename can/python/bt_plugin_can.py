@@ -1,6 +1,23 @@
+import array
+import bisect
 import bt2
-import cantools
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import mmap
+import multiprocessing
+import operator
+import os
+import queue
 import struct
+import sys
+import threading
+import time
+import zlib
 
 bt2.register_plugin(
     module_name=__name__,
@@ -20,45 +37,1355 @@ def print_info(text):
     print("INFO: {}".format(text))
 
 
+class _Stats(object):
+    """
+        Counters and time (in seconds) spent in each stage of a component
+        created with `stats`, not counting the stages nested in it. Stages are
+        timed by wrapping their methods with `timed`.
+    """
+
+    # Statistics of the components of this process, by name, for the `stats`
+    # query.
+    by_name = dict()
+
+    def __init__(self, name):
+        self.counters = collections.Counter()
+        self.times = collections.defaultdict(float)
+        self._nested_time = 0.0
+        _Stats.by_name[name] = self
+
+    def timed(self, stage, function):
+        def _timed(*args, **kwargs):
+            (outer_nested_time, self._nested_time) = (self._nested_time, 0.0)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.times[stage] += elapsed - self._nested_time
+                self._nested_time = outer_nested_time + elapsed
+
+        return _timed
+
+    def timed_iter(self, stage, iterator):
+        # Same as `timed`, for getting each item of `iterator`.
+        end = object()
+        timed_next = self.timed(stage, functools.partial(next, iter(iterator), end))
+        return iter(timed_next, end)
+
+    def to_dict(self):
+        return {"counters": dict(self.counters), "times": dict(self.times)}
+
+    def dump(self, name):
+        print(
+            f"STATS: {name}: {json.dumps(self.to_dict(), sort_keys=True)}",
+            file=sys.stderr,
+        )
+
+    @staticmethod
+    def query(params):
+        # The statistics of the component named by the `component` parameter,
+        # or of every component.
+        if params is None or "component" not in params:
+            return {name: s.to_dict() for (name, s) in _Stats.by_name.items()}
+
+        name = str(params["component"])
+        if name not in _Stats.by_name:
+            raise ValueError(f"no statistics for component `{name}`")
+
+        return _Stats.by_name[name].to_dict()
+
+
+# Custom binary format parsing.
+#
+# [bytes 0 -  3] timestamp
+# [bytes 4 -  7] frame ID (standard or extended)
+# [bytes 8 - 15] up to 64 bits of data
+_RECORD = struct.Struct("<ii8s")
+
+# Number of records decoded at once from the mapped file.
+_CHUNK_RECORDS = 4096
+
+
+# Number of records between two entries of a trace index.
+_INDEX_INTERVAL = 4096
+
+# Trace index header: magic, trace size and trace modification time (ns).
+_INDEX_HEADER = struct.Struct("<8sqq")
+_INDEX_MAGIC = b"CANIDX1\0"
+
+
+# Number of records decoded by a worker process in a single task.
+_TASK_RECORDS = 65536
+
+
+# Version 2 container, with 64-bit nanosecond timestamps and the DLC of the
+# frames, in independently compressed blocks of records:
+#
+# [header] magic, compression (see `_V2_COMPRESSIONS`)
+# [blocks] compressed block payloads, each made of the timestamps (`<q`), the
+#          frame IDs (`<I`) and the DLCs (`B`, 0 to 8) of its records, then
+#          their data, DLC bytes per record
+# [index]  one entry per block: offset, compressed size, record count, first
+#          and last timestamp
+# [footer] offset of the index, number of blocks, magic
+_V2_MAGIC = b"CANTRC2\0"
+_V2_HEADER = struct.Struct("<8sB7x")
+_V2_BLOCK = struct.Struct("<QIIqq")
+_V2_FOOTER = struct.Struct("<QI8s")
+_V2_COMPRESSIONS = ["none", "zlib", "zstd", "lz4"]
+
+# Legacy traces have millisecond timestamps, converted to nanoseconds when
+# they are read along with v2 traces.
+_NS_PER_MS = 1000000
+
+
+def _read_record_chunks(path, start=0, stop=None):
+    # Map the whole trace and unpack it a chunk at a time, from record number
+    # `start` to `stop`, which avoids a read call per frame. A trailing partial
+    # record is ignored.
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        size -= size % _RECORD.size
+        if stop is not None:
+            size = min(size, stop * _RECORD.size)
+        if size <= start * _RECORD.size:
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            chunk_size = _CHUNK_RECORDS * _RECORD.size
+            for offset in range(start * _RECORD.size, size, chunk_size):
+                chunk = buf[offset : min(offset + chunk_size, size)]
+                yield _RECORD.iter_unpack(chunk)
+
+
+def _pread_record_chunks(path, start=0, stop=None):
+    # Like `_read_record_chunks`, but with a read call per chunk. Unlike the
+    # page faults of a mapping, reads release the GIL, so that another thread
+    # can run while the chunk is read from the disk.
+    with open(path, "rb") as f:
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        size -= size % _RECORD.size
+        if stop is not None:
+            size = min(size, stop * _RECORD.size)
+        chunk_size = _CHUNK_RECORDS * _RECORD.size
+
+        for offset in range(start * _RECORD.size, size, chunk_size):
+            chunk = os.pread(fd, min(chunk_size, size - offset), offset)
+            chunk = chunk[: len(chunk) - len(chunk) % _RECORD.size]
+            if len(chunk) == 0:
+                return
+
+            yield _RECORD.iter_unpack(chunk)
+
+
+def _write_sidecar(path, write_fn):
+    # Atomically replaces `path` with what `write_fn` writes to a binary file.
+    # Sidecar files are only an optimization, a read-only directory is not an
+    # error.
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            write_fn(f)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+class _RecordIndex(object):
+    """
+        Sampled timestamps of a CAN trace, one every `_INDEX_INTERVAL`
+        records, used to find the first record at or after a given timestamp
+        without reading the whole trace.
+
+        The index is built on first use and persisted next to the trace as
+        `<trace>.idx`. It is rebuilt when the trace size or modification time
+        doesn't match the ones it was built for.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._index_path = f"{path}.idx"
+
+        stat = os.stat(path)
+        self._stat = (stat.st_size, stat.st_mtime_ns)
+        self._count = stat.st_size // _RECORD.size
+
+        self._timestamps = self._load()
+        if self._timestamps is None:
+            self._timestamps = self._build()
+            self._save()
+
+    def _load(self):
+        try:
+            with open(self._index_path, "rb") as f:
+                header = f.read(_INDEX_HEADER.size)
+                if len(header) != _INDEX_HEADER.size:
+                    return None
+
+                (magic, size, mtime) = _INDEX_HEADER.unpack(header)
+                if magic != _INDEX_MAGIC or (size, mtime) != self._stat:
+                    return None
+
+                timestamps = array.array("i")
+                timestamps.frombytes(f.read())
+        except (OSError, ValueError):
+            return None
+
+        if len(timestamps) != -(-self._count // _INDEX_INTERVAL):
+            return None
+
+        return timestamps
+
+    def _build(self):
+        timestamps = array.array("i")
+        if self._count == 0:
+            return timestamps
+
+        with open(self._path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                stride = _INDEX_INTERVAL * _RECORD.size
+                for offset in range(0, self._count * _RECORD.size, stride):
+                    timestamps.append(_RECORD.unpack_from(buf, offset)[0])
+
+        return timestamps
+
+    def _save(self):
+        def write(f):
+            f.write(_INDEX_HEADER.pack(_INDEX_MAGIC, *self._stat))
+            self._timestamps.tofile(f)
+
+        _write_sidecar(self._index_path, write)
+
+    def find(self, timestamp):
+        # Bisect the sampled timestamps to find the block containing the
+        # first record at or after `timestamp`, then bisect the block itself.
+        block = bisect.bisect_left(self._timestamps, timestamp)
+        if block == 0:
+            return 0
+
+        low = (block - 1) * _INDEX_INTERVAL
+        high = min(block * _INDEX_INTERVAL, self._count)
+
+        with open(self._path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                while low < high:
+                    middle = (low + high) // 2
+                    if _RECORD.unpack_from(buf, middle * _RECORD.size)[0] < timestamp:
+                        low = middle + 1
+                    else:
+                        high = middle
+
+        return low
+
+
+def _import_compression(compression):
+    # zstd and lz4 are optional, their modules are only needed by the traces
+    # using them.
+    try:
+        if compression == "zstd":
+            import zstandard
+
+            return zstandard
+        elif compression == "lz4":
+            import lz4.frame
+
+            return lz4.frame
+    except ImportError as err:
+        raise ValueError(
+            f"{compression} compressed traces require the `{err.name}` module"
+        ) from err
+
+    return None
+
+
+def _compress_block(compression, payload):
+    if compression == "none":
+        return payload
+    elif compression == "zlib":
+        return zlib.compress(payload)
+    elif compression == "zstd":
+        return _import_compression(compression).ZstdCompressor().compress(payload)
+    else:
+        return _import_compression(compression).compress(payload)
+
+
+def _decompress_block(compression, block):
+    if compression == "none":
+        return block
+    elif compression == "zlib":
+        return zlib.decompress(block)
+    elif compression == "zstd":
+        return _import_compression(compression).ZstdDecompressor().decompress(block)
+    else:
+        return _import_compression(compression).decompress(block)
+
+
+def _pack_v2_block(records):
+    # Returns the payload of a block of (timestamp, frame ID, data) records.
+    count = len(records)
+    (timestamps, frame_ids, data) = zip(*records)
+
+    return b"".join(
+        [
+            struct.pack(f"<{count}q", *timestamps),
+            struct.pack(f"<{count}I", *frame_ids),
+            bytes(len(frame_data) for frame_data in data),
+        ]
+        + list(data)
+    )
+
+
+def _unpack_v2_block(payload, count):
+    # Returns the (timestamp, frame ID, data) records of a block payload, the
+    # data being padded to 8 bytes like in legacy traces.
+    timestamps = struct.unpack_from(f"<{count}q", payload, 0)
+    frame_ids = struct.unpack_from(f"<{count}I", payload, 8 * count)
+
+    lengths = payload[12 * count : 13 * count]
+    # Frames usually have 8 bytes of data, which are then unpacked at once.
+    if lengths.count(8) == count:
+        data = struct.unpack_from("8s" * count, payload, 13 * count)
+    else:
+        data = []
+        offset = 13 * count
+        for length in lengths:
+            data.append(payload[offset : offset + length].ljust(8, b"\0"))
+            offset += length
+
+    return list(zip(timestamps, frame_ids, data))
+
+
+class _TraceFile(object):
+    """
+        A CAN trace, either legacy (`_RECORD` records, with millisecond
+        timestamps) or a v2 container (see `_V2_MAGIC`, with nanosecond
+        timestamps), detected from its first bytes.
+
+        Records are numbered from 0 in both formats. The timestamps of a
+        legacy trace are multiplied by `timestamp_scale`, so that they can be
+        read with the same clock as v2 traces.
+    """
+
+    def __init__(self, path, timestamp_scale=1):
+        self.path = path
+        self.timestamp_scale = timestamp_scale
+        self._index = None
+
+        with open(path, "rb") as f:
+            header = f.read(_V2_HEADER.size)
+            self.is_v2 = header.startswith(_V2_MAGIC)
+            if self.is_v2:
+                self._load_blocks(f, header)
+
+    def _load_blocks(self, f, header):
+        # Only the index of the blocks is read, at the end of the container.
+        (_, compression) = _V2_HEADER.unpack(header)
+        if compression >= len(_V2_COMPRESSIONS):
+            raise ValueError(f"unknown compression in trace `{self.path}`")
+        self._compression = _V2_COMPRESSIONS[compression]
+
+        size = os.fstat(f.fileno()).st_size
+        footer = os.pread(f.fileno(), _V2_FOOTER.size, size - _V2_FOOTER.size)
+        if len(footer) != _V2_FOOTER.size or not footer.endswith(_V2_MAGIC):
+            raise ValueError(f"trace `{self.path}` is truncated or corrupted")
+
+        (offset, count, _) = _V2_FOOTER.unpack(footer)
+        index = os.pread(f.fileno(), count * _V2_BLOCK.size, offset)
+        self._blocks = list(_V2_BLOCK.iter_unpack(index))
+
+        # Number of the first record of each block, then of the record after
+        # the last one.
+        self._block_starts = [0]
+        for (_, _, records, _, _) in self._blocks:
+            self._block_starts.append(self._block_starts[-1] + records)
+
+        self._last_timestamps = [block[4] for block in self._blocks]
+
+    def count(self):
+        if self.is_v2:
+            return self._block_starts[-1]
+
+        return os.stat(self.path).st_size // _RECORD.size
+
+    def _read_payload(self, f, block, counters=None):
+        (offset, size, _, _, _) = self._blocks[block]
+        data = os.pread(f.fileno(), size, offset)
+        if counters is not None:
+            counters["bytes-read"] += len(data)
+
+        return _decompress_block(self._compression, data)
+
+    def _read_block(self, f, block, counters=None):
+        payload = self._read_payload(f, block, counters)
+        return _unpack_v2_block(payload, self._blocks[block][2])
+
+    def read_payloads(self):
+        """
+            Yields the (record count, payload) of each block of a v2 trace,
+            see `_V2_MAGIC` for the layout of a payload.
+        """
+        with open(self.path, "rb") as f:
+            for block in range(len(self._blocks)):
+                yield (self._blocks[block][2], self._read_payload(f, block))
+
+    def _read_blocks(self, start, stop, counters):
+        # Only the blocks overlapping `start` to `stop` are decompressed.
+        if stop is None:
+            stop = self.count()
+
+        with open(self.path, "rb") as f:
+            block = bisect.bisect_right(self._block_starts, start) - 1
+            while block < len(self._blocks) and self._block_starts[block] < stop:
+                records = self._read_block(f, block, counters)
+                first = self._block_starts[block]
+                yield records[max(start - first, 0) : stop - first]
+                block += 1
+
+    def read_chunks(self, start=0, stop=None, pread=False, counters=None):
+        """
+            Yields the records from record number `start` to `stop` by chunks
+            of (timestamp, frame ID, data). Legacy traces are read with a read
+            call per chunk when `pread` is true, see `_pread_record_chunks`.
+            The number of bytes read is added to the `bytes-read` counter of
+            `counters`, when given.
+        """
+        if self.is_v2:
+            yield from self._read_blocks(start, stop, counters)
+            return
+
+        if pread:
+            chunks = _pread_record_chunks(self.path, start, stop)
+        else:
+            chunks = _read_record_chunks(self.path, start, stop)
+
+        scale = self.timestamp_scale
+        for records in chunks:
+            if counters is not None:
+                counters["bytes-read"] += operator.length_hint(records) * _RECORD.size
+
+            if scale != 1:
+                records = [
+                    (timestamp * scale, frame_id, data)
+                    for (timestamp, frame_id, data) in records
+                ]
+
+            yield records
+
+    def find(self, ns_from_origin):
+        """
+            Returns the number of the first record at or after
+            `ns_from_origin`, the clocks of both formats having no offset.
+        """
+        if not self.is_v2:
+            if self._index is None:
+                self._index = _RecordIndex(self.path)
+
+            return self._index.find(-(-ns_from_origin // _NS_PER_MS))
+
+        block = bisect.bisect_left(self._last_timestamps, ns_from_origin)
+        if block == len(self._blocks):
+            return self.count()
+
+        with open(self.path, "rb") as f:
+            records = self._read_block(f, block)
+
+        timestamps = [record[0] for record in records]
+        return self._block_starts[block] + bisect.bisect_left(
+            timestamps, ns_from_origin
+        )
+
+
+def _expand_inputs(paths):
+    # Replace the directories of `paths` by the CAN traces they contain, at
+    # any depth: legacy `.data` files and v2 containers.
+    expanded = []
+    for path in paths:
+        if not os.path.isdir(path):
+            expanded.append(path)
+            continue
+
+        traces = []
+        for (directory, _, files) in os.walk(path):
+            for name in files:
+                file_path = os.path.join(directory, name)
+                if name.endswith(".data") or _is_v2_trace(file_path):
+                    traces.append(file_path)
+
+        expanded.extend(sorted(traces))
+
+    return expanded
+
+
+def _is_v2_trace(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(_V2_MAGIC)) == _V2_MAGIC
+    except OSError:
+        return False
+
+
+# Version of the summaries stored in trace info sidecars, to bump whenever
+# they change.
+_TRACE_INFO_VERSION = 1
+
+
+def _read_trace_info(path):
+    # Returns the summary stored in the `<trace>.info.json` sidecar of the
+    # trace at `path`, or `None` if it is missing or out of date.
+    try:
+        stat = os.stat(path)
+        with open(f"{path}.info.json") as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(info, dict) or info.get("version") != _TRACE_INFO_VERSION:
+        return None
+
+    if [info.get("size"), info.get("mtime-ns")] != [stat.st_size, stat.st_mtime_ns]:
+        return None
+
+    return info.get("summary")
+
+
+def _write_trace_info(path, stat, summary):
+    info = {
+        "version": _TRACE_INFO_VERSION,
+        "size": stat.st_size,
+        "mtime-ns": stat.st_mtime_ns,
+        "summary": summary,
+    }
+    data = json.dumps(info, sort_keys=True).encode()
+    _write_sidecar(f"{path}.info.json", lambda f: f.write(data))
+
+
+def _summarize_trace(path):
+    """
+        Returns the summary of the trace at `path`, after saving it to its
+        sidecar: the first and last timestamps (in ns, `None` without frames),
+        the number of frames and, for each frame ID, the number of frames and
+        their first and last timestamps.
+
+        This reads the whole trace, and runs in a worker process when several
+        traces are summarized.
+    """
+    trace = CANSource._open_trace(path)
+
+    # Taken first, so that a trace modified while being read isn't trusted.
+    stat = os.stat(path)
+    trace.timestamp_scale = 1 if trace.is_v2 else _NS_PER_MS
+
+    # [count, first timestamp, last timestamp] by frame ID.
+    frame_ids = dict()
+    begin = None
+    end = None
+    for records in trace.read_chunks():
+        if len(records) == 0:
+            continue
+
+        if begin is None:
+            begin = records[0][0]
+        end = records[-1][0]
+
+        for (timestamp, frame_id, _) in records:
+            frame_id_info = frame_ids.get(frame_id)
+            if frame_id_info is None:
+                frame_ids[frame_id] = [1, timestamp, timestamp]
+            else:
+                frame_id_info[0] += 1
+                frame_id_info[2] = timestamp
+
+    summary = {
+        "begin": begin,
+        "end": end,
+        "events": sum(count for (count, _, _) in frame_ids.values()),
+        "frame-ids": {
+            str(frame_id): {"events": count, "begin": first, "end": last}
+            for (frame_id, (count, first, last)) in frame_ids.items()
+        },
+    }
+    _write_trace_info(path, stat, summary)
+
+    return summary
+
+
+def _get_summary_range(summary, record_filter):
+    """
+        Returns the (begin, end) timestamps (in ns) of the frames of a trace
+        summary selected by `record_filter` (or all of them when `None`), or
+        `None` if there are none.
+
+        The range comes from the timestamps of the selected frame IDs, clipped
+        to the `begin`/`end` window of the filter: when the window falls
+        between frames, it starts before the first frame emitted or ends after
+        the last one.
+    """
+    (begin, end) = (None, None)
+    for (frame_id, frame_id_info) in summary["frame-ids"].items():
+        if record_filter is not None and not record_filter.accepts_frame_id(
+            int(frame_id)
+        ):
+            continue
+
+        if begin is None:
+            (begin, end) = (frame_id_info["begin"], frame_id_info["end"])
+        else:
+            begin = min(begin, frame_id_info["begin"])
+            end = max(end, frame_id_info["end"])
+
+    if begin is None:
+        return None
+
+    if record_filter is not None:
+        return record_filter.clip(begin, end)
+
+    return (begin, end)
+
+
+def _get_trace_summaries(paths):
+    # Returns the summary of each trace of `paths`, from their sidecars when
+    # they are up to date. The others are summarized by worker processes.
+    summaries = {path: _read_trace_info(path) for path in paths}
+    missing = [path for (path, summary) in summaries.items() if summary is None]
+
+    if len(missing) > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+            mp_context=multiprocessing.get_context("fork")
+        ) as pool:
+            for (path, summary) in zip(missing, pool.map(_summarize_trace, missing)):
+                summaries[path] = summary
+    else:
+        for path in missing:
+            summaries[path] = _summarize_trace(path)
+
+    return summaries
+
+
+# Version of the layout stored in database caches, to bump whenever it changes.
+_DATABASE_CACHE_VERSION = 2
+
+
+_Signal = collections.namedtuple(
+    "_Signal",
+    [
+        "name",
+        "start",
+        "length",
+        "byte_order",
+        "is_signed",
+        "is_float",
+        "scale",
+        "offset",
+        "unit",
+        "choices",
+    ],
+)
+
+
+class _Message(object):
+    """
+        Layout of a CAN message: the part of `cantools.database.Message` used
+        by this plugin, built from plain values so that databases can be
+        cached without importing cantools.
+    """
+
+    def __init__(self, name, frame_id, signals, signal_tree):
+        self.name = name
+        self.frame_id = frame_id
+        self.signals = [_Signal(*signal) for signal in signals]
+        self.signal_tree = signal_tree
+        self._signals_by_name = {signal.name: signal for signal in self.signals}
+
+    def get_signal_by_name(self, name):
+        return self._signals_by_name[name]
+
+    def get_multiplexed_payloads(self):
+        """
+            Returns the name of the multiplexer signal of this message and, by
+            multiplexer value in increasing order, the names of the signals of
+            the payload: the multiplexer, the signals it selects, then the
+            other signals.
+        """
+        multiplexer = None
+        signals = []
+        for signal in self.signal_tree:
+            if isinstance(signal, str):
+                signals.append(signal)
+            elif multiplexer is None:
+                multiplexer = signal
+            else:
+                raise ValueError(f"multiple multiplexer in message `{self.name}`")
+
+        if multiplexer is None or len(multiplexer) == 0:
+            raise ValueError(f"no multiplexer found in `{self.name}`")
+
+        if len(multiplexer) > 1:
+            raise ValueError(f"more than 1 multiplexer found in `{self.name}`")
+
+        key = list(multiplexer.keys())[0]
+        payloads = dict()
+        for value in sorted(multiplexer[key].keys()):
+            payloads[value] = [key] + multiplexer[key][value] + signals
+
+        return (key, payloads)
+
+
+def _parse_database(path):
+    # cantools is slow to import and only needed when the cache misses.
+    import cantools
+
+    layout = []
+    for message in cantools.db.load_file(path).messages:
+        signals = [
+            (
+                signal.name,
+                signal.start,
+                signal.length,
+                signal.byte_order,
+                signal.is_signed,
+                signal.is_float,
+                signal.scale,
+                signal.offset,
+                signal.unit,
+                # Names may be `NamedSignalValue` objects, which aren't needed.
+                sorted((value, str(name)) for (value, name) in signal.choices.items())
+                if signal.choices
+                else None,
+            )
+            for signal in message.signals
+        ]
+        # The signal tree is already made of strings, lists and dicts.
+        layout.append((message.name, message.frame_id, signals, message.signal_tree))
+
+    return layout
+
+
+def _load_signal_tree(tree):
+    # JSON object keys are strings, while the multiplexer values of a signal
+    # tree are integers.
+    return [
+        node
+        if isinstance(node, str)
+        else {
+            name: {
+                int(value): _load_signal_tree(nodes)
+                for (value, nodes) in values.items()
+            }
+            for (name, values) in node.items()
+        }
+        for node in tree
+    ]
+
+
+def _read_database_cache(cache_path):
+    # Returns the (key, digest, layout) stored in a database cache, or `None`
+    # if it is missing, corrupted or of another version. The cache is JSON,
+    # as the database directory may be writable by others.
+    try:
+        with open(cache_path) as f:
+            (version, key, digest, layout) = json.load(f)
+
+        if version != _DATABASE_CACHE_VERSION:
+            return None
+
+        layout = [
+            (name, frame_id, signals, _load_signal_tree(signal_tree))
+            for (name, frame_id, signals, signal_tree) in layout
+        ]
+        return (tuple(key), bytes.fromhex(digest), layout)
+    except Exception:
+        return None
+
+
+def _write_database_cache(cache_path, key, digest, layout):
+    cache = (_DATABASE_CACHE_VERSION, key, digest.hex(), layout)
+    _write_sidecar(cache_path, lambda f: f.write(json.dumps(cache).encode()))
+
+
+def _load_database(path):
+    """
+        Returns the messages of the database at `path`.
+
+        Parsing a large database takes seconds, so its layout is cached next to
+        it as `<database>.cache`. The cache is used when the database size and
+        modification time match the ones it was built for or, failing that,
+        when the database content still has the same SHA-256 digest.
+    """
+    cache_path = f"{path}.cache"
+    stat = os.stat(path)
+    key = (stat.st_size, stat.st_mtime_ns)
+
+    cache = _read_database_cache(cache_path)
+    if cache is not None and cache[0] == key:
+        layout = cache[2]
+    else:
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).digest()
+
+        if cache is not None and cache[1] == digest:
+            layout = cache[2]
+        else:
+            layout = _parse_database(path)
+
+        _write_database_cache(cache_path, key, digest, layout)
+
+    return [_Message(*message) for message in layout]
+
+
+def _compile_signal(signal, raw=False):
+    # Precompute where `signal` lives in the 64-bit frame data, so decoding it
+    # is a shift and a mask on the integer value of the data. With `raw`, the
+    # value isn't scaled.
+    if signal.byte_order == "little_endian":
+        big_endian = False
+        shift = signal.start
+    else:
+        # Big endian start bits use the DBC sawtooth numbering and point at
+        # the most significant bit of the signal.
+        big_endian = True
+        msb = 8 * (signal.start // 8) + 7 - signal.start % 8
+        shift = 64 - msb - signal.length
+
+    mask = (1 << signal.length) - 1
+
+    if signal.is_float:
+        float_format = "<f" if signal.length == 32 else "<d"
+    else:
+        float_format = None
+
+    if signal.is_signed and not signal.is_float:
+        sign_bit = 1 << (signal.length - 1)
+    else:
+        sign_bit = 0
+
+    return (
+        big_endian,
+        shift,
+        mask,
+        sign_bit,
+        float_format,
+        signal.length // 8,
+        1 if raw else signal.scale,
+        0 if raw else signal.offset,
+    )
+
+
+def _decode_signals(signals, data):
+    little = int.from_bytes(data, "little")
+    big = int.from_bytes(data, "big")
+
+    values = []
+    for big_endian, shift, mask, sign_bit, float_format, size, scale, offset in signals:
+        raw = ((big if big_endian else little) >> shift) & mask
+        if float_format is not None:
+            (raw,) = struct.unpack(float_format, raw.to_bytes(size, "little"))
+        elif raw & sign_bit:
+            raw -= sign_bit << 1
+        values.append(raw * scale + offset)
+
+    return tuple(values)
+
+
+class _MessageDecoder(object):
+    """
+        Decodes the data of a regular CAN message.
+
+        Signals are compiled once, in the order of the event class payload
+        members, so that `decode` returns values which can be assigned without
+        looking up the decoded signals by name. With `raw`, the values aren't
+        scaled.
+    """
+
+    def __init__(self, event_class, signals, raw):
+        self._event_class = event_class
+        self._names = tuple(signal.name for signal in signals)
+        self._signals = [_compile_signal(signal, raw) for signal in signals]
+
+    def decode(self, data):
+        return (self._event_class, self._names, _decode_signals(self._signals, data))
+
+    def decode_values(self, data):
+        return (None, _decode_signals(self._signals, data))
+
+    def resolve(self, variant):
+        return (self._event_class, self._names)
+
+
+class _MultiplexedMessageDecoder(object):
+    """
+        Decodes the data of a multiplexed CAN message.
+
+        The multiplexer signal is decoded first to select the event class, then
+        the signals of that event class are decoded in payload member order.
+    """
+
+    def __init__(self, message, event_classes, key, raw):
+        self._name = message.name
+        self._multiplexer = [_compile_signal(message.get_signal_by_name(key), raw)]
+        self._decoders = dict()
+
+        for value, event_class in event_classes.items():
+            signals = [
+                message.get_signal_by_name(name)
+                for name in event_class.payload_field_class.keys()
+            ]
+            self._decoders[value] = _MessageDecoder(event_class, signals, raw)
+
+    def _decoder(self, data):
+        (value,) = _decode_signals(self._multiplexer, data)
+
+        try:
+            return (value, self._decoders[value])
+        except KeyError:
+            raise ValueError(
+                f"unknown multiplexer value {value} in message `{self._name}`"
+            )
+
+    def decode(self, data):
+        (value, decoder) = self._decoder(data)
+        return decoder.decode(data)
+
+    def decode_values(self, data):
+        (value, decoder) = self._decoder(data)
+        return (value, decoder.decode_values(data)[1])
+
+    def resolve(self, variant):
+        return self._decoders[variant].resolve(None)
+
+
+# Decoding state of a worker process, see `_init_decode_worker`.
+_worker_messages = None
+_worker_decode = None
+
+
+def _init_decode_worker(messages, cache_size):
+    # Worker processes are forked, so the decoders are inherited rather than
+    # pickled. Only `decode_values` is used here, as it returns plain values.
+    global _worker_messages, _worker_decode
+
+    _worker_messages = messages
+
+    def _decode(frame_id, data):
+        return _worker_messages[frame_id].decode_values(data)
+
+    if cache_size > 0:
+        _decode = functools.lru_cache(maxsize=cache_size)(_decode)
+
+    _worker_decode = _decode
+
+
+def _decode_record_range(index, trace, start, stop, record_filter):
+    # Decode records `start` to `stop` of input number `index` in a worker
+    # process. Returns the decoded records and the timestamp of the last record
+    # read, which tells if the rest of the input is past the filter's end.
+    records = itertools.chain.from_iterable(trace.read_chunks(start, stop))
+    last_timestamp = None
+    decoded = []
+
+    for (timestamp, frame_id, data) in records:
+        last_timestamp = timestamp
+
+        if record_filter is not None and not record_filter.accepts(timestamp, frame_id):
+            continue
+
+        if frame_id in _worker_messages:
+            values = _worker_decode(frame_id, data)
+        else:
+            values = None
+
+        decoded.append((index, timestamp, frame_id, data, values))
+
+    return (decoded, last_timestamp)
+
+
+def _merge_decoded_records(pool, depth, traces, starts, record_filter):
+    # Decode every input in the worker processes and merge the results by
+    # timestamp. Up to `depth` tasks per input are submitted ahead of the
+    # records being consumed, to keep the workers busy. Returns the merged
+    # records and the deques of pending tasks of each input, see
+    # `CANIterator._stop_merge`.
+    pending = [collections.deque() for _ in traces]
+
+    def _input_records(index, trace, start):
+        count = trace.count()
+        tasks = pending[index]
+
+        for task_start in range(start, count, _TASK_RECORDS):
+            task_stop = min(task_start + _TASK_RECORDS, count)
+            tasks.append(
+                pool.submit(
+                    _decode_record_range,
+                    index,
+                    trace,
+                    task_start,
+                    task_stop,
+                    record_filter,
+                )
+            )
+
+            if len(tasks) < depth:
+                continue
+
+            (decoded, last_timestamp) = tasks.popleft().result()
+            yield from decoded
+
+            if record_filter is not None and record_filter.is_past_end(last_timestamp):
+                break
+
+        while len(tasks) > 0:
+            (decoded, last_timestamp) = tasks.popleft().result()
+            yield from decoded
+
+    merged = heapq.merge(
+        *[
+            _input_records(index, trace, start)
+            for (index, (trace, start)) in enumerate(zip(traces, starts))
+        ],
+        key=operator.itemgetter(1),
+    )
+
+    return (merged, pending)
+
+
+class _Prefetcher(object):
+    """
+        Reads, filters and decodes the chunks of records of `chunks` in a
+        background thread, up to `depth` chunks ahead of the records being
+        consumed, so that reading overlaps with the creation of the messages.
+
+        Iterating yields (timestamp, frame ID, data, decoded) tuples, where
+        `decoded` is the result of `decode` or `None` for unknown frames. The
+        thread must be stopped with `close` before another one reads the same
+        decoding cache.
+    """
+
+    def __init__(self, chunks, record_filter, messages, decode, depth):
+        self._queue = queue.Queue(maxsize=depth)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(chunks, record_filter, messages, decode),
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _run(self, chunks, record_filter, messages, decode):
+        try:
+            for records in chunks:
+                records = list(records)
+                if len(records) == 0:
+                    continue
+
+                last_timestamp = records[-1][0]
+                if record_filter is not None:
+                    records = record_filter.filter(records)
+
+                decoded = [
+                    (
+                        timestamp,
+                        frame_id,
+                        data,
+                        decode(frame_id, data) if frame_id in messages else None,
+                    )
+                    for (timestamp, frame_id, data) in records
+                ]
+                if not self._put(decoded):
+                    return
+
+                if record_filter is not None and record_filter.is_past_end(
+                    last_timestamp
+                ):
+                    break
+        except BaseException as e:
+            # Raised again by the consumer.
+            self._put(e)
+            return
+
+        self._put(None)
+
+    def _put(self, item):
+        # Give up once closed, rather than waiting for a consumer which is gone.
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            if isinstance(item, BaseException):
+                raise item
+
+            yield from item
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+
+
+class _ComplementSet(object):
+    """
+        Set of every value except the ones in `excluded`.
+    """
+
+    def __init__(self, excluded):
+        self._excluded = frozenset(excluded)
+
+    def __contains__(self, value):
+        return value not in self._excluded
+
+
+class _RecordFilter(object):
+    """
+        Selects raw records by frame ID and timestamp, before they are decoded.
+
+        `accepted` and `rejected` are sets of frame IDs (or `None` for no
+        constraint), `begin` and `end` are inclusive timestamps (or `None`).
+    """
+
+    def __init__(self, accepted, rejected, begin, end):
+        self._accepted = accepted
+        self._rejected = rejected
+        self._begin = begin
+        self._end = end
+
+    def filter(self, records):
+        accepted = self._accepted
+        rejected = self._rejected
+        begin = self._begin
+        end = self._end
+
+        for record in records:
+            (timestamp, frame_id, data) = record
+
+            if begin is not None and timestamp < begin:
+                continue
+
+            # Records are ordered by timestamp, nothing more can match.
+            if end is not None and timestamp > end:
+                return
+
+            if accepted is not None and frame_id not in accepted:
+                continue
+
+            if rejected is not None and frame_id in rejected:
+                continue
+
+            yield record
+
+    def accepts(self, timestamp, frame_id):
+        if self._begin is not None and timestamp < self._begin:
+            return False
+
+        if self._end is not None and timestamp > self._end:
+            return False
+
+        return self.accepts_frame_id(frame_id)
+
+    def accepts_frame_id(self, frame_id):
+        if self._accepted is not None and frame_id not in self._accepted:
+            return False
+
+        return self._rejected is None or frame_id not in self._rejected
+
+    def clip(self, begin, end):
+        # Returns the part of the [begin, end] range within the filter's one,
+        # or `None` if there is none.
+        if self._begin is not None:
+            begin = max(begin, self._begin)
+        if self._end is not None:
+            end = min(end, self._end)
+
+        if begin > end:
+            return None
+
+        return (begin, end)
+
+    def is_past_end(self, timestamp):
+        return self._end is not None and timestamp is not None and timestamp > self._end
+
+
 class CANIterator(bt2._UserMessageIterator):
     def __init__(self, config, port):
-        path, trace_class, self._messages = port.user_data
-        self._file = open(path, "rb")
+        (
+            self._traces,
+            trace_class,
+            self._messages,
+            cache_size,
+            self._record_filter,
+            jobs,
+            self._stats,
+            self._prefetch,
+            compact_fields,
+        ) = port.user_data
 
         trace = trace_class()
 
         stream_class = trace_class[0]
-        self._stream = trace.create_stream(stream_class)
-        self._init_msgs = [self._create_stream_beginning_message(self._stream)]
-        self._end_msgs = [self._create_stream_end_message(self._stream)]
-
-        self._next = self._next_init
-
-    def _create_decoded_event(self, timestamp, frame_id, bytedata):
-        if len(self._messages[frame_id]) == 2:
-            (database, event_class) = self._messages[frame_id]
-            decoded_data = database.decode_message(frame_id, bytedata)
-        elif len(self._messages[frame_id]) == 3:
-            (database, event_classes, key) = self._messages[frame_id]
-            decoded_data = database.decode_message(frame_id, bytedata)
-            event_class = event_classes[decoded_data[key]]
+        if jobs == 0:
+            # Periodic frames very often repeat the same data, so decoded
+            # payloads are cached by frame ID and data.
+            if cache_size > 0:
+                self._decode = functools.lru_cache(maxsize=cache_size)(self._decode)
+
+            self._pool = None
+            self._prefetcher = None
+            self._streams = [trace.create_stream(stream_class)]
         else:
-            raise ValueError
+            # Inputs are decoded by forked worker processes, one stream per
+            # input, and merged here by timestamp.
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_init_decode_worker,
+                initargs=(self._messages, cache_size),
+            )
+            self._depth = 2 * jobs
+            self._streams = [
+                trace.create_stream(stream_class, name=input_trace.path)
+                for input_trace in self._traces
+            ]
+
+        self._stream = self._streams[0]
+        self._merge = None
+
+        if compact_fields:
+            self._create_unknown_event = self._create_compact_unknown_event
+
+        if self._stats is not None:
+            self._instrument(self._stats)
+
+        self._start([0] * len(self._traces))
+
+    def _instrument(self, stats):
+        # Count and time the stages of the hot path by wrapping the methods
+        # doing them. Decoding is done by the worker processes with `jobs` or
+        # the prefetching thread with `prefetch`, and is then part of reading.
+        # Creating an event is creating its message, then assigning its
+        # payload fields.
+        create_event_message = stats.timed("create", self._create_event_message)
+        create_unknown_event = stats.timed("assign", self._create_unknown_event)
+
+        def _create_event_message(event_class, *args, **kwargs):
+            stats.counters[f"events.{event_class.name}"] += 1
+            return create_event_message(event_class, *args, **kwargs)
+
+        def _create_unknown_event(stream, timestamp, frame_id, bytedata):
+            stats.counters[f"unknown-frame-ids.{frame_id:#x}"] += 1
+            return create_unknown_event(stream, timestamp, frame_id, bytedata)
+
+        self._create_event_message = _create_event_message
+        self._create_decoded_event = stats.timed("assign", self._create_decoded_event)
+        self._create_unknown_event = _create_unknown_event
+        if self._prefetch == 0:
+            self._decode = stats.timed("decode", self._decode)
+
+    def _user_finalize(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+        elif self._prefetcher is not None:
+            self._prefetcher.close()
+
+    def _start(self, records):
+        # (Re)start reading every input at the given record numbers.
+        counters = None if self._stats is None else self._stats.counters
+
+        if self._pool is None and self._prefetch > 0:
+            if self._prefetcher is not None:
+                self._prefetcher.close()
+
+            chunks = self._traces[0].read_chunks(
+                records[0], pread=True, counters=counters
+            )
+
+            self._prefetcher = _Prefetcher(
+                chunks,
+                self._record_filter,
+                self._messages,
+                self._decode,
+                self._prefetch,
+            )
+            self._records = iter(self._prefetcher)
+
+            generate_msgs = self._generate_prefetched_msgs
+        elif self._pool is None:
+            chunks = self._traces[0].read_chunks(records[0], counters=counters)
+            self._records = itertools.chain.from_iterable(chunks)
+            if self._record_filter is not None:
+                self._records = self._record_filter.filter(self._records)
+
+            generate_msgs = self._generate_read_msgs
+        else:
+            self._stop_merge()
+            self._merge = _merge_decoded_records(
+                self._pool, self._depth, self._traces, records, self._record_filter
+            )
+            self._records = self._merge[0]
+
+            generate_msgs = self._generate_merged_msgs
+
+        if self._stats is not None:
+            self._records = self._stats.timed_iter("read", self._records)
+
+        self._msgs = generate_msgs()
+
+    def _stop_merge(self):
+        # Close the current merge of decoded records, and cancel the decoding
+        # tasks it submitted that didn't start yet, so that the workers are
+        # free for the next one.
+        if self._merge is None:
+            return
+
+        (merged, pending) = self._merge
+        merged.close()
+        for tasks in pending:
+            for task in tasks:
+                task.cancel()
 
+            tasks.clear()
+
+        self._merge = None
+
+    def _user_can_seek_beginning(self):
+        return True
+
+    def _user_seek_beginning(self):
+        self._start([0] * len(self._traces))
+
+    def _user_can_seek_ns_from_origin(self, ns_from_origin):
+        return True
+
+    def _user_seek_ns_from_origin(self, ns_from_origin):
+        self._start([trace.find(ns_from_origin) for trace in self._traces])
+
+    def _decode(self, frame_id, bytedata):
+        return self._messages[frame_id].decode(bytedata)
+
+    def _create_decoded_event(self, stream, timestamp, event_class, names, values):
         event_msg = self._create_event_message(
-            event_class, self._stream, default_clock_snapshot=timestamp
+            event_class, stream, default_clock_snapshot=timestamp
         )
 
-        for key in event_msg.event.payload_field.keys():
-            event_msg.event.payload_field[key] = decoded_data[key]
+        payload_field = event_msg.event.payload_field
+        for name, value in zip(names, values):
+            payload_field[name] = value
 
         return event_msg
 
-    def _create_unknown_event(self, timestamp, frame_id, bytedata):
+    def _create_unknown_event(self, stream, timestamp, frame_id, bytedata):
         event_class = self._messages[None]
 
         event_msg = self._create_event_message(
-            event_class, self._stream, default_clock_snapshot=timestamp
+            event_class, stream, default_clock_snapshot=timestamp
         )
 
         event_msg.event.payload_field["id"] = frame_id
@@ -67,42 +1394,89 @@ class CANIterator(bt2._UserMessageIterator):
 
         return event_msg
 
-    def _next_init(self):
-        if len(self._init_msgs) > 0:
-            return self._init_msgs.pop(0)
-        else:
-            self._next = self._next_events
-            return self._next()
+    def _create_compact_unknown_event(self, stream, timestamp, frame_id, bytedata):
+        event_class = self._messages[None]
 
-    def _next_events(self):
-        # Custom binary format parsing.
-        #
-        # [bytes 0 -  3] timestamp
-        # [bytes 4 -  7] frame ID (standard or extended)
-        # [bytes 8 - 15] up to 64 bits of data
+        event_msg = self._create_event_message(
+            event_class, stream, default_clock_snapshot=timestamp
+        )
 
-        msg = self._file.read(16)
-        if msg == b"":
-            self._next = self._next_end
-            return self._next()
+        # The ID is read as a signed integer, but its top bit is a flag (e.g.
+        # the extended frame format flag of SocketCAN).
+        payload_field = event_msg.event.payload_field
+        payload_field["id"] = frame_id & 0xFFFFFFFF
+        for i in range(8):
+            payload_field[f"byte {i}"] = bytedata[i]
 
-        timestamp, frame_id, data = struct.unpack("<ii8s", msg)
+        return event_msg
 
-        if frame_id in self._messages:
-            event_msg = self._create_decoded_event(timestamp, frame_id, data)
-        else:
-            event_msg = self._create_unknown_event(timestamp, frame_id, data)
+    # The messages of the iterator are produced by a single generator, from
+    # the stream beginnings to the stream ends, so that each call to
+    # `__next__` only resumes it. The methods it calls are looked up once.
 
-        return event_msg
+    def _generate_read_msgs(self):
+        stream = self._stream
+        messages = self._messages
+        decode = self._decode
+        create_decoded_event = self._create_decoded_event
+        create_unknown_event = self._create_unknown_event
 
-    def _next_end(self):
-        if len(self._end_msgs) > 0:
-            return self._end_msgs.pop(0)
-        else:
-            raise StopIteration
+        yield self._create_stream_beginning_message(stream)
+
+        for (timestamp, frame_id, data) in self._records:
+            if frame_id in messages:
+                (event_class, names, values) = decode(frame_id, data)
+                yield create_decoded_event(
+                    stream, timestamp, event_class, names, values
+                )
+            else:
+                yield create_unknown_event(stream, timestamp, frame_id, data)
+
+        yield self._create_stream_end_message(stream)
+
+    def _generate_prefetched_msgs(self):
+        stream = self._stream
+        create_decoded_event = self._create_decoded_event
+        create_unknown_event = self._create_unknown_event
+
+        yield self._create_stream_beginning_message(stream)
+
+        for (timestamp, frame_id, data, decoded) in self._records:
+            if decoded is not None:
+                (event_class, names, values) = decoded
+                yield create_decoded_event(
+                    stream, timestamp, event_class, names, values
+                )
+            else:
+                yield create_unknown_event(stream, timestamp, frame_id, data)
+
+        yield self._create_stream_end_message(stream)
+
+    def _generate_merged_msgs(self):
+        streams = self._streams
+        messages = self._messages
+        create_decoded_event = self._create_decoded_event
+        create_unknown_event = self._create_unknown_event
+
+        for stream in streams:
+            yield self._create_stream_beginning_message(stream)
+
+        for (index, timestamp, frame_id, data, values) in self._records:
+            stream = streams[index]
+            if values is not None:
+                (variant, values) = values
+                (event_class, names) = messages[frame_id].resolve(variant)
+                yield create_decoded_event(
+                    stream, timestamp, event_class, names, values
+                )
+            else:
+                yield create_unknown_event(stream, timestamp, frame_id, data)
+
+        for stream in streams:
+            yield self._create_stream_end_message(stream)
 
     def __next__(self):
-        return self._next()
+        return next(self._msgs)
 
 
 @bt2.plugin_component_class
@@ -110,15 +1484,136 @@ class CANSource(bt2._UserSourceComponent, message_iterator_class=CANIterator):
     def __init__(self, config, params, obj):
         inputs = CANSource._get_param_list(params, "inputs")
         databases = CANSource._get_param_list(params, "databases")
+        cache_size = CANSource._get_param_int(params, "decode-cache-size", 4096)
+        if cache_size < 0:
+            raise ValueError("expecting `decode-cache-size` to not be negative")
 
+        # With `compact-fields`, signals are raw integers sized like in the
+        # databases rather than scaled doubles, see `_create_signal_field_class`.
+        self._compact_fields = CANSource._get_param_bool(
+            params, "compact-fields", False
+        )
+
+        # Legacy traces have a 1 kHz clock, v2 traces a 1 GHz one. When both
+        # are read, legacy timestamps are converted to nanoseconds.
+        paths = _expand_inputs([str(path) for path in inputs])
+        traces = [CANSource._open_trace(path) for path in paths]
+        self._timestamp_scale = 1
+        if any(trace.is_v2 for trace in traces):
+            self._timestamp_scale = _NS_PER_MS
+            for trace in traces:
+                trace.timestamp_scale = _NS_PER_MS
+
+        self._frame_ids = dict()
         (trace_class, messages) = self._create_trace_class_for_databases(databases)
+        record_filter = CANSource._create_record_filter(
+            params, self._frame_ids, messages.keys(), self._timestamp_scale
+        )
+
+        # With `jobs`, all inputs are decoded by a pool of worker processes
+        # and merged into a single port.
+        jobs = CANSource._get_param_int(params, "jobs", 0)
+        if jobs < 0:
+            raise ValueError("expecting `jobs` to not be negative")
+
+        # With `prefetch`, and without `jobs`, the iterators read and decode up
+        # to this many chunks of records ahead in a thread, see `_Prefetcher`.
+        self._prefetch = CANSource._get_param_int(params, "prefetch", 0)
+        if self._prefetch < 0:
+            raise ValueError("expecting `prefetch` to not be negative")
+
+        # With `stats`, the iterators count events and time their stages, see
+        # `_Stats`.
+        self._stats = None
+        if CANSource._get_param_bool(params, "stats", False):
+            self._stats = _Stats(self.name)
+
+        if jobs == 0:
+            for trace in traces:
+                self._create_port_for_can_trace(
+                    trace_class, messages, cache_size, record_filter, [trace], 0
+                )
+        else:
+            self._create_port_for_can_trace(
+                trace_class, messages, cache_size, record_filter, traces, jobs
+            )
+
+    def _user_finalize(self):
+        if self._stats is not None:
+            self._stats.dump(self.name)
+
+    @staticmethod
+    def _create_record_filter(params, frame_ids_by_name, known_frame_ids, scale):
+        # `frame_ids_by_name` and `known_frame_ids` come from the databases,
+        # `scale` is the number of clock cycles per millisecond.
+        accepted = CANSource._get_frame_id_set(
+            params, "frame-ids", "messages", frame_ids_by_name, known_frame_ids
+        )
+        rejected = CANSource._get_frame_id_set(
+            params,
+            "exclude-frame-ids",
+            "exclude-messages",
+            frame_ids_by_name,
+            known_frame_ids,
+        )
+        begin = CANSource._get_param_int(params, "begin", None)
+        end = CANSource._get_param_int(params, "end", None)
+
+        if begin is not None and end is not None and begin > end:
+            raise ValueError("expecting `begin` to not be greater than `end`")
+
+        if accepted is None and rejected is None and begin is None and end is None:
+            return None
+
+        # `begin` and `end` are in milliseconds, whatever the clock.
+        if begin is not None:
+            begin *= scale
+        if end is not None:
+            end = end * scale + scale - 1
+
+        return _RecordFilter(accepted, rejected, begin, end)
+
+    @staticmethod
+    def _get_frame_id_set(
+        params, ids_key, names_key, frame_ids_by_name, known_frame_ids
+    ):
+        # Unknown frames are selected by name with `UNKNOWN`, which stands for
+        # every frame ID absent from the databases.
+        if ids_key not in params and names_key not in params:
+            return None
+
+        frame_ids = set()
+        unknown = False
+
+        if ids_key in params:
+            for frame_id in CANSource._get_param_list(params, ids_key):
+                if type(frame_id) not in [
+                    bt2._SignedIntegerValueConst,
+                    bt2._UnsignedIntegerValueConst,
+                ]:
+                    raise TypeError(
+                        f"expecting `{ids_key}` elements to be integers, got a {type(frame_id)}"
+                    )
+                frame_ids.add(int(frame_id))
+
+        if names_key in params:
+            for name in CANSource._get_param_list(params, names_key):
+                name = str(name)
+                if name == "UNKNOWN":
+                    unknown = True
+                elif name in frame_ids_by_name:
+                    frame_ids.add(frame_ids_by_name[name])
+                else:
+                    raise ValueError(f"unknown message `{name}` in `{names_key}`")
 
-        for path in inputs:
-            self._create_port_for_can_trace(trace_class, messages, str(path))
+        if unknown:
+            return _ComplementSet(known_frame_ids - frame_ids)
+
+        return frame_ids
 
     def _create_trace_class_for_databases(self, databases):
         messages = dict()
-        clock_class = self._create_clock_class(frequency=1000)
+        clock_class = self._create_clock_class(frequency=1000 * self._timestamp_scale)
         trace_class = self._create_trace_class()
         stream_class = trace_class.create_stream_class(
             name="can", default_clock_class=clock_class
@@ -127,7 +1622,9 @@ class CANSource(bt2._UserSourceComponent, message_iterator_class=CANIterator):
         if log_info(self.logging_level):
             print_info(f"created trace class {trace_class}")
 
-        event_class = CANSource._create_unknown_event_class(trace_class, stream_class)
+        event_class = CANSource._create_unknown_event_class(
+            trace_class, stream_class, self._compact_fields
+        )
         messages[None] = event_class
 
         if log_info(self.logging_level):
@@ -140,8 +1637,31 @@ class CANSource(bt2._UserSourceComponent, message_iterator_class=CANIterator):
 
         return (trace_class, messages)
 
-    def _create_port_for_can_trace(self, trace_class, messages, path):
-        self._add_output_port(path, (path, trace_class, messages))
+    @staticmethod
+    def _open_trace(path):
+        try:
+            return _TraceFile(path)
+        except FileNotFoundError as err:
+            raise ValueError(f"input file `{path}` couldn't be read.") from err
+
+    def _create_port_for_can_trace(
+        self, trace_class, messages, cache_size, record_filter, traces, jobs
+    ):
+        name = traces[0].path if jobs == 0 else "out"
+        self._add_output_port(
+            name,
+            (
+                traces,
+                trace_class,
+                messages,
+                cache_size,
+                record_filter,
+                jobs,
+                self._stats,
+                self._prefetch,
+                self._compact_fields,
+            ),
+        )
 
     @staticmethod
     def _get_param_list(params, key):
@@ -159,13 +1679,101 @@ class CANSource(bt2._UserSourceComponent, message_iterator_class=CANIterator):
 
         return param
 
+    @staticmethod
+    def _get_param_int(params, key, default):
+        if key not in params:
+            return default
+        param = params[key]
+
+        if type(param) not in [
+            bt2._SignedIntegerValueConst,
+            bt2._UnsignedIntegerValueConst,
+        ]:
+            raise TypeError(
+                f"expecting `{key}` parameter to be an integer, got a {type(param)}"
+            )
+
+        return int(param)
+
+    @staticmethod
+    def _get_param_bool(params, key, default):
+        if key not in params:
+            return default
+        param = params[key]
+
+        if type(param) != bt2._BoolValueConst:
+            raise TypeError(
+                f"expecting `{key}` parameter to be a boolean, got a {type(param)}"
+            )
+
+        return bool(param)
+
+    @staticmethod
+    def _user_query(query_executor, obj, params, log_level):
+        if obj == "babeltrace.trace-infos":
+            return CANSource._query_trace_infos(params)
+        elif obj == "stats":
+            return _Stats.query(params)
+        else:
+            raise bt2.UnknownObject
+
+    @staticmethod
+    def _query_trace_infos(params):
+        # The time range of each stream comes from the trace summaries, laid
+        # out like the ports created for the same `inputs` and `jobs`, and
+        # restricted to the frames selected by the same filter parameters.
+        paths = _expand_inputs(
+            [str(path) for path in CANSource._get_param_list(params, "inputs")]
+        )
+        jobs = CANSource._get_param_int(params, "jobs", 0)
+
+        # Message names are only resolved with the databases when given.
+        frame_ids_by_name = dict()
+        known_frame_ids = set()
+        if "databases" in params:
+            for path in CANSource._get_param_list(params, "databases"):
+                try:
+                    database = _load_database(str(path))
+                except FileNotFoundError as err:
+                    raise ValueError(
+                        f"database file `{path}` couldn't be read."
+                    ) from err
+
+                for message in database:
+                    frame_ids_by_name.setdefault(message.name, message.frame_id)
+                    known_frame_ids.add(message.frame_id)
+
+        # Summaries are in nanoseconds.
+        record_filter = CANSource._create_record_filter(
+            params, frame_ids_by_name, known_frame_ids, _NS_PER_MS
+        )
+        summaries = _get_trace_summaries(paths)
+
+        stream_infos = []
+        for path in paths:
+            stream_info = {"port-name": path if jobs == 0 else "out"}
+            time_range = _get_summary_range(summaries[path], record_filter)
+            if time_range is not None:
+                stream_info["range-ns"] = {
+                    "begin": time_range[0],
+                    "end": time_range[1],
+                }
+            stream_infos.append(stream_info)
+
+        if jobs == 0:
+            return [{"stream-infos": [stream_info]} for stream_info in stream_infos]
+
+        return [{"stream-infos": stream_infos}]
+
     def _create_database_event_classes(self, trace_class, stream_class, path, messages):
         try:
-            database = cantools.db.load_file(path)
+            database = _load_database(path)
         except FileNotFoundError as err:
             raise ValueError(f"database file `{path}` couldn't be read.") from err
 
-        for message in database.messages:
+        for message in database:
+            self._frame_ids.setdefault(message.name, message.frame_id)
+
             if message.frame_id in messages:
                 if log_info(self.logging_level):
                     print_info(f"{message.name} already present in another database")
@@ -181,29 +1789,49 @@ class CANSource(bt2._UserSourceComponent, message_iterator_class=CANIterator):
 
             if multiplexed:
                 (event_classes, key) = CANSource._create_multiplexed_message_classes(
-                    trace_class, stream_class, message
+                    trace_class, stream_class, message, self._compact_fields
+                )
+                messages[message.frame_id] = _MultiplexedMessageDecoder(
+                    message, event_classes, key, self._compact_fields
                 )
-                messages[message.frame_id] = [database, event_classes, key]
                 if log_info(self.logging_level):
-                    print_info(f"created event class '{message.name}' at {event_class}")
+                    print_info(
+                        f"created event classes '{message.name}' at {event_classes}"
+                    )
             else:
                 event_class = CANSource._create_message_class(
-                    trace_class, stream_class, message
+                    trace_class, stream_class, message, self._compact_fields
+                )
+                messages[message.frame_id] = _MessageDecoder(
+                    event_class,
+                    CANSource._sorted_signals(message),
+                    self._compact_fields,
                 )
-                messages[message.frame_id] = [database, event_class]
                 if log_info(self.logging_level):
                     print_info(f"created event class '{message.name}' at {event_class}")
 
     @staticmethod
-    def _create_unknown_event_class(trace_class, stream_class):
+    def _create_unknown_event_class(trace_class, stream_class, compact):
         field_class = trace_class.create_structure_field_class()
-        field_class.append_member(
-            "id", trace_class.create_double_precision_real_field_class()
-        )
-        for i in range(8):
+        if compact:
             field_class.append_member(
-                f"byte {i}", trace_class.create_double_precision_real_field_class()
+                "id",
+                trace_class.create_unsigned_integer_field_class(
+                    32, preferred_display_base=bt2.IntegerDisplayBase.HEXADECIMAL
+                ),
             )
+            for i in range(8):
+                field_class.append_member(
+                    f"byte {i}", trace_class.create_unsigned_integer_field_class(8)
+                )
+        else:
+            field_class.append_member(
+                "id", trace_class.create_double_precision_real_field_class()
+            )
+            for i in range(8):
+                field_class.append_member(
+                    f"byte {i}", trace_class.create_double_precision_real_field_class()
+                )
 
         event_class = stream_class.create_event_class(
             name="UNKNOWN", payload_field_class=field_class
@@ -212,38 +1840,77 @@ class CANSource(bt2._UserSourceComponent, message_iterator_class=CANIterator):
         return event_class
 
     @staticmethod
-    def _create_multiplexed_message_classes(trace_class, stream_class, message):
-        event_classes = dict()
+    def _create_signal_field_class(trace_class, signal, compact):
+        """
+            Creates the field class of the values of `signal`.
 
-        multiplexer = None
-        signals = []
-        for signal in message.signal_tree:
-            if isinstance(signal, str):
-                signals.append(signal)
-            elif multiplexer is None:
-                multiplexer = signal
+            Values are doubles, already scaled, by default. When `compact`,
+            they are raw: integers of the signal length (enumerations when the
+            signal has a value table) or single/double precision reals, the
+            scale, offset and unit being user attributes of the field class.
+        """
+        if not compact:
+            return trace_class.create_double_precision_real_field_class()
+
+        user_attributes = {"scale": float(signal.scale), "offset": float(signal.offset)}
+        if signal.unit:
+            user_attributes["unit"] = signal.unit
+
+        if signal.is_float and signal.length == 32:
+            return trace_class.create_single_precision_real_field_class(
+                user_attributes=user_attributes
+            )
+
+        if signal.is_float:
+            return trace_class.create_double_precision_real_field_class(
+                user_attributes=user_attributes
+            )
+
+        if signal.choices is None:
+            if signal.is_signed:
+                create = trace_class.create_signed_integer_field_class
             else:
-                raise ValueError(f"multiple multiplexer in message `{message.name}`")
+                create = trace_class.create_unsigned_integer_field_class
 
-        if multiplexer is None or len(multiplexer) == 0:
-            raise ValueError(f"no multiplexer found in `{message.name}`")
+            return create(signal.length, user_attributes=user_attributes)
 
-        if len(multiplexer) > 1:
-            raise ValueError(f"more than 1 multiplexer found in `{message.name}`")
+        if signal.is_signed:
+            field_class = trace_class.create_signed_enumeration_field_class(
+                signal.length, user_attributes=user_attributes
+            )
+            range_set_type = bt2.SignedIntegerRangeSet
+        else:
+            field_class = trace_class.create_unsigned_enumeration_field_class(
+                signal.length, user_attributes=user_attributes
+            )
+            range_set_type = bt2.UnsignedIntegerRangeSet
 
-        key = list(multiplexer.keys())[0]
-        for value in sorted(multiplexer[key].keys()):
+        # Labels of enumeration mappings are unique, but a value table may give
+        # the same name to several values.
+        ranges = collections.defaultdict(list)
+        for (value, name) in signal.choices:
+            ranges[name].append((value, value))
+
+        for (name, values) in ranges.items():
+            field_class.add_mapping(name, range_set_type(values))
+
+        return field_class
+
+    @staticmethod
+    def _create_multiplexed_message_classes(
+        trace_class, stream_class, message, compact
+    ):
+        event_classes = dict()
+
+        (key, payloads) = message.get_multiplexed_payloads()
+        for (value, names) in payloads.items():
             field_class = trace_class.create_structure_field_class()
-            field_class.append_member(
-                key, trace_class.create_double_precision_real_field_class()
-            )
-            for signal in multiplexer[key][value]:
-                field_class.append_member(
-                    signal, trace_class.create_double_precision_real_field_class()
-                )
-            for signal in signals:
+            for name in names:
                 field_class.append_member(
-                    signal, trace_class.create_double_precision_real_field_class()
+                    name,
+                    CANSource._create_signal_field_class(
+                        trace_class, message.get_signal_by_name(name), compact
+                    ),
                 )
 
             event_class = stream_class.create_event_class(
@@ -254,15 +1921,20 @@ class CANSource(bt2._UserSourceComponent, message_iterator_class=CANIterator):
         return (event_classes, key)
 
     @staticmethod
-    def _create_message_class(trace_class, stream_class, message):
-        field_class = trace_class.create_structure_field_class()
-
+    def _sorted_signals(message):
         def _by_start_bit(sig):
             return sig.start
 
-        for signal in sorted(message.signals, key=_by_start_bit):
+        return sorted(message.signals, key=_by_start_bit)
+
+    @staticmethod
+    def _create_message_class(trace_class, stream_class, message, compact):
+        field_class = trace_class.create_structure_field_class()
+
+        for signal in CANSource._sorted_signals(message):
             field_class.append_member(
-                signal.name, trace_class.create_double_precision_real_field_class()
+                signal.name,
+                CANSource._create_signal_field_class(trace_class, signal, compact),
             )
 
         event_class = stream_class.create_event_class(
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+
+"""
+    Converts CAN traces to NumPy arrays without going through babeltrace2.
+
+    The frames are decoded with the databases and the decoders of the CAN
+    plugin (`bt_plugin_can.py`, next to this script), but a whole signal at
+    a time: records are grouped by frame ID and each signal is extracted from
+    all the frames of its message with array operations.
+"""
+
+import argparse
+import heapq
+import itertools
+import operator
+import os
+import sys
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bt_plugin_can
+
+# Same layout as `bt_plugin_can._RECORD`, the data being read as a 64-bit
+# integer.
+_RECORD_DTYPE = numpy.dtype(
+    [("timestamp", "<i4"), ("frame_id", "<i4"), ("data", "<u8")]
+)
+
+# Records of v2 traces, or of traces of both formats, have 64-bit timestamps
+# and room for unsigned frame IDs.
+_V2_RECORD_DTYPE = numpy.dtype(
+    [("timestamp", "<i8"), ("frame_id", "<i8"), ("data", "<u8")]
+)
+
+
+def read_v2_records(trace):
+    """
+        Returns the records of the v2 trace `trace` (a
+        `bt_plugin_can._TraceFile`), the data being padded to 8 bytes.
+    """
+    blocks = []
+    for (count, payload) in trace.read_payloads():
+        block = numpy.empty(count, dtype=_V2_RECORD_DTYPE)
+        block["timestamp"] = numpy.frombuffer(payload, "<i8", count, 0)
+        block["frame_id"] = numpy.frombuffer(payload, "<u4", count, 8 * count)
+        lengths = numpy.frombuffer(payload, "u1", count, 12 * count)
+
+        # The data of the records is contiguous, fill each row up to its DLC.
+        data = numpy.zeros((count, 8), dtype=numpy.uint8)
+        data[numpy.arange(8) < lengths[:, None]] = numpy.frombuffer(
+            payload, "u1", int(lengths.sum()), 13 * count
+        )
+        block["data"] = data.view("<u8")[:, 0]
+        blocks.append(block)
+
+    if len(blocks) == 0:
+        return numpy.empty(0, dtype=_V2_RECORD_DTYPE)
+
+    return numpy.concatenate(blocks)
+
+
+def read_records(paths):
+    """
+        Returns the records of the traces at `paths`, merged by timestamp. A
+        trailing partial record of a legacy trace is ignored. If any trace is
+        a v2 one, timestamps are in nanoseconds.
+    """
+    traces = [bt_plugin_can._TraceFile(path) for path in paths]
+    v2 = any(trace.is_v2 for trace in traces)
+
+    records = []
+    for trace in traces:
+        if trace.is_v2:
+            records.append(read_v2_records(trace))
+            continue
+
+        # Legacy traces are mapped rather than read, so that only the records
+        # being grouped or decoded are loaded in memory.
+        count = os.path.getsize(trace.path) // _RECORD_DTYPE.itemsize
+        if count == 0:
+            legacy = numpy.empty(0, dtype=_RECORD_DTYPE)
+        else:
+            legacy = numpy.memmap(
+                trace.path, dtype=_RECORD_DTYPE, mode="r", shape=(count,)
+            )
+
+        if v2:
+            legacy = legacy.astype(_V2_RECORD_DTYPE)
+            legacy["timestamp"] *= bt_plugin_can._NS_PER_MS
+
+        records.append(legacy)
+
+    if len(records) == 1:
+        return records[0]
+
+    # A stable sort keeps the order of the inputs for equal timestamps, like
+    # the plugin does when merging them.
+    records = numpy.concatenate(records)
+    return records[numpy.argsort(records["timestamp"], kind="stable")]
+
+
+def decode_signal(signal, little, big):
+    """
+        Decodes a signal compiled by `bt_plugin_can._compile_signal` from the
+        data of frames, as integers read in little and big endian order.
+    """
+    (big_endian, shift, mask, sign_bit, float_format, size, scale, offset) = signal
+
+    raw = ((big if big_endian else little) >> numpy.uint64(shift)) & numpy.uint64(mask)
+    if float_format == "<f":
+        values = raw.astype(numpy.uint32).view(numpy.float32)
+    elif float_format == "<d":
+        values = raw.view(numpy.float64)
+    elif sign_bit:
+        # Sign-extend by moving the sign bit to the top of a 64-bit integer.
+        unused = 64 - mask.bit_length()
+        values = (raw << numpy.uint64(unused)).view(numpy.int64) >> unused
+    else:
+        values = raw
+
+    exact = float_format is None and isinstance(scale, int)
+    if exact and mask.bit_length() + abs(scale).bit_length() > 53:
+        # Like the plugin, scale the integers before rounding them to doubles.
+        return (values.astype(object) * scale + offset).astype(numpy.float64)
+
+    # Floating point data may hold NaN or infinite values.
+    with numpy.errstate(invalid="ignore", over="ignore"):
+        return values.astype(numpy.float64) * scale + offset
+
+
+def decode_message(message, timestamps, little, big):
+    """
+        Decodes the frames of `message`. Returns a list of (name, columns),
+        one per event class of the message in the plugin with frames,
+        `columns` being a dict of the timestamps and of the values of the
+        signals, in payload order. Also returns the number of frames with an
+        unknown multiplexer value, which can't be decoded.
+    """
+    if not any(isinstance(node, dict) for node in message.signal_tree):
+        signals = bt_plugin_can.CANSource._sorted_signals(message)
+        columns = {"timestamp": timestamps.astype(numpy.int64)}
+        for signal in signals:
+            compiled = bt_plugin_can._compile_signal(signal)
+            columns[signal.name] = decode_signal(compiled, little, big)
+
+        return ([(message.name, columns)], 0)
+
+    # Multiplexed messages are split by multiplexer value, as their payload
+    # depends on it.
+    (key, payloads) = message.get_multiplexed_payloads()
+    multiplexer = bt_plugin_can._compile_signal(message.get_signal_by_name(key))
+    multiplexer_values = decode_signal(multiplexer, little, big)
+    undecoded = len(timestamps) - numpy.isin(multiplexer_values, list(payloads)).sum()
+
+    results = []
+    for (value, names) in payloads.items():
+        selected = multiplexer_values == value
+        if not selected.any():
+            continue
+
+        columns = {"timestamp": timestamps[selected].astype(numpy.int64)}
+        for name in names:
+            compiled = bt_plugin_can._compile_signal(message.get_signal_by_name(name))
+            columns[name] = decode_signal(compiled, little[selected], big[selected])
+
+        results.append((f"{message.name}-{value}", columns))
+
+    return (results, int(undecoded))
+
+
+def load_messages(databases):
+    # Messages by frame ID. Like the plugin, the first database defining a
+    # frame ID wins.
+    messages = dict()
+    for path in databases:
+        for message in bt_plugin_can._load_database(path):
+            messages.setdefault(message.frame_id, message)
+
+    return messages
+
+
+def convert_to_npz(args):
+    messages = load_messages(args.databases)
+    records = read_records(args.inputs)
+    save = numpy.savez_compressed if args.compress else numpy.savez
+    os.makedirs(args.output, exist_ok=True)
+
+    # Group records by frame ID, keeping them in timestamp order.
+    order = numpy.argsort(records["frame_id"], kind="stable")
+    frame_ids = records["frame_id"][order]
+    (ids, starts) = numpy.unique(frame_ids, return_index=True)
+    ends = numpy.append(starts[1:], len(order))
+
+    unknown = []
+    for (frame_id, start, end) in zip(ids.tolist(), starts, ends):
+        group = records[order[start:end]]
+        if frame_id not in messages:
+            unknown.append(group)
+            continue
+
+        message = messages[frame_id]
+        little = group["data"]
+        (results, undecoded) = decode_message(
+            message, group["timestamp"], little, little.byteswap()
+        )
+
+        # The plugin fails on such frames, skip them instead.
+        if undecoded > 0:
+            print(
+                f"WARNING: skipped {undecoded} frames of `{message.name}` with an unknown multiplexer value",
+                file=sys.stderr,
+            )
+
+        for (name, columns) in results:
+            save(os.path.join(args.output, f"{name}.npz"), **columns)
+
+    # Like the UNKNOWN event class of the plugin, frames absent from the
+    # databases are kept undecoded.
+    if len(unknown) > 0:
+        group = numpy.concatenate(unknown)
+        group = group[numpy.argsort(group["timestamp"], kind="stable")]
+        save(
+            os.path.join(args.output, "UNKNOWN.npz"),
+            timestamp=group["timestamp"].astype(numpy.int64),
+            id=group["frame_id"].astype(numpy.int64),
+            data=numpy.ascontiguousarray(group["data"])
+            .view(numpy.uint8)
+            .reshape(-1, 8),
+        )
+
+
+def write_v2(path, records, compression, block_records):
+    """
+        Writes the (timestamp, frame ID, data) records of `records`, in
+        timestamp order, to a v2 trace at `path`, `block_records` records per
+        block.
+    """
+    index = []
+    with open(path, "wb") as f:
+        f.write(
+            bt_plugin_can._V2_HEADER.pack(
+                bt_plugin_can._V2_MAGIC,
+                bt_plugin_can._V2_COMPRESSIONS.index(compression),
+            )
+        )
+
+        while True:
+            block = list(itertools.islice(records, block_records))
+            if len(block) == 0:
+                break
+
+            data = bt_plugin_can._compress_block(
+                compression, bt_plugin_can._pack_v2_block(block)
+            )
+            index.append(
+                bt_plugin_can._V2_BLOCK.pack(
+                    f.tell(), len(data), len(block), block[0][0], block[-1][0]
+                )
+            )
+            f.write(data)
+
+        offset = f.tell()
+        f.write(b"".join(index))
+        f.write(
+            bt_plugin_can._V2_FOOTER.pack(offset, len(index), bt_plugin_can._V2_MAGIC)
+        )
+
+
+def convert_to_v2(args):
+    # Fail before writing anything if the compression module is missing.
+    bt_plugin_can._import_compression(args.compression)
+
+    traces = [bt_plugin_can._TraceFile(path) for path in args.inputs]
+    for trace in traces:
+        if not trace.is_v2:
+            trace.timestamp_scale = bt_plugin_can._NS_PER_MS
+
+    # Like the plugin with `jobs`, the inputs are merged by timestamp, in input
+    # order for equal timestamps. Frame IDs are unsigned in v2 traces, and
+    # legacy traces have no DLC: their 8 bytes of data are kept.
+    records = heapq.merge(
+        *[itertools.chain.from_iterable(trace.read_chunks()) for trace in traces],
+        key=operator.itemgetter(0),
+    )
+    records = (
+        (timestamp, frame_id & 0xFFFFFFFF, data)
+        for (timestamp, frame_id, data) in records
+    )
+
+    write_v2(args.output, records, args.compression, args.block_records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    npz = subparsers.add_parser(
+        "npz", help="write the signals of each message to a .npz file"
+    )
+    npz.add_argument("inputs", nargs="+", metavar="INPUT", help="CAN trace")
+    npz.add_argument(
+        "-d",
+        "--database",
+        action="append",
+        required=True,
+        dest="databases",
+        help="database file, may be repeated",
+    )
+    npz.add_argument("-o", "--output", required=True, help="output directory")
+    npz.add_argument("--compress", action="store_true", help="compress the .npz files")
+    npz.set_defaults(function=convert_to_npz)
+
+    v2 = subparsers.add_parser(
+        "v2", help="write a compressed v2 trace, with nanosecond timestamps"
+    )
+    v2.add_argument("inputs", nargs="+", metavar="INPUT", help="CAN trace")
+    v2.add_argument("-o", "--output", required=True, help="output trace")
+    v2.add_argument(
+        "-c",
+        "--compression",
+        choices=bt_plugin_can._V2_COMPRESSIONS,
+        default="zlib",
+        help="compression of the blocks (default: zlib)",
+    )
+    v2.add_argument(
+        "--block-records",
+        type=int,
+        default=16384,
+        help="number of records per block (default: 16384)",
+    )
+    v2.set_defaults(function=convert_to_v2)
+
+    args = parser.parse_args()
+    args.function(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+"""
+    Checks that converting legacy CAN traces to v2 traces keeps their records.
+
+    Each legacy trace is converted like `can_convert.py v2` does, once per
+    available compression, with small blocks so that seeking crosses them.
+    The records read back from the blocks of the v2 trace must be the ones of
+    the legacy trace. `find()` must return the same record numbers in both
+    traces for timestamps around sampled records, and reading the v2 trace
+    from them must start at the same record.
+"""
+
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bt_plugin_can
+import can_convert
+
+
+def _read_records(trace, start=0):
+    return itertools.chain.from_iterable(trace.read_chunks(start))
+
+
+def check_trace(path, output, compression, block_records, samples):
+    """
+        Converts the legacy trace at `path` to a v2 trace at `output` and
+        compares them. Returns the list of differences found.
+    """
+    args = argparse.Namespace(
+        inputs=[path],
+        output=output,
+        compression=compression,
+        block_records=block_records,
+    )
+    can_convert.convert_to_v2(args)
+
+    legacy = bt_plugin_can._TraceFile(path, bt_plugin_can._NS_PER_MS)
+    v2 = bt_plugin_can._TraceFile(output)
+    if legacy.count() != v2.count():
+        return [f"{v2.count()} records instead of {legacy.count()}"]
+
+    # Legacy traces have signed frame IDs, v2 traces unsigned ones.
+    timestamps = []
+    for (number, (record, v2_record)) in enumerate(
+        zip(_read_records(legacy), _read_records(v2))
+    ):
+        (timestamp, frame_id, data) = record
+        expected = (timestamp, frame_id & 0xFFFFFFFF, data)
+        if v2_record != expected:
+            return [f"record {number} is {v2_record} instead of {expected}"]
+
+        timestamps.append(timestamp)
+
+    errors = []
+    count = len(timestamps)
+    numbers = list(range(count))
+    sampled = random.Random(0).sample(numbers, min(samples, count))
+    for number in numbers[:1] + numbers[-1:] + sampled:
+        timestamp = timestamps[number]
+        for ns in (
+            timestamp - bt_plugin_can._NS_PER_MS,
+            timestamp - 1,
+            timestamp,
+            timestamp + 1,
+        ):
+            (expected, found) = (legacy.find(ns), v2.find(ns))
+            if found != expected:
+                errors.append(f"find({ns}) is record {found} instead of {expected}")
+                continue
+
+            first = next(_read_records(v2, found), (None,))[0]
+            if first != (timestamps[expected] if expected < count else None):
+                errors.append(f"reading from find({ns}) starts at {first}")
+
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("inputs", nargs="+", metavar="INPUT", help="legacy CAN trace")
+    parser.add_argument(
+        "--block-records",
+        type=int,
+        default=1000,
+        help="number of records per block (default: 1000)",
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=1000,
+        help="number of records to seek around (default: 1000)",
+    )
+    args = parser.parse_args()
+
+    failed = False
+
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, "trace.v2")
+        for path in args.inputs:
+            if bt_plugin_can._TraceFile(path).is_v2:
+                print(f"{path}: skipped, not a legacy trace")
+                continue
+
+            for compression in bt_plugin_can._V2_COMPRESSIONS:
+                try:
+                    bt_plugin_can._import_compression(compression)
+                except ValueError as err:
+                    print(f"{path} ({compression}): skipped, {err}")
+                    continue
+
+                errors = check_trace(
+                    path, output, compression, args.block_records, args.samples,
+                )
+                print(f"{path} ({compression}): {'FAILED' if errors else 'OK'}")
+                for error in errors:
+                    print(f"    {error}")
+
+                failed = failed or len(errors) > 0
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
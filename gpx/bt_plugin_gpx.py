@@ -1,72 +1,649 @@
 import bt2
+import calendar
+import collections
+import concurrent.futures
+import functools
+import itertools
+import json
+import multiprocessing
 import os
+import sys
+import time
 import xml.etree.ElementTree as etree
-from datetime import datetime
+import xml.parsers.expat as expat
+from datetime import date, datetime, timezone
+
+_GPX_NS = "{http://www.topografix.com/GPX/1/1}"
+_GPX_TAG = _GPX_NS + "gpx"
+_TRK_TAG = _GPX_NS + "trk"
+_TRKSEG_TAG = _GPX_NS + "trkseg"
+_TRKPT_TAG = _GPX_NS + "trkpt"
+_RTE_TAG = _GPX_NS + "rte"
+_RTEPT_TAG = _GPX_NS + "rtept"
+_WPT_TAG = _GPX_NS + "wpt"
+_ELE_TAG = _GPX_NS + "ele"
+_TIME_TAG = _GPX_NS + "time"
+_NAME_TAG = _GPX_NS + "name"
+
+_POINT_TAGS = {"trk": _TRKPT_TAG, "rte": _RTEPT_TAG, "wpt": _WPT_TAG}
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# Size of the reads of gpx files.
+_READ_SIZE = 64 * 1024
+
+# Maximum number of points of the chunks of a port, the unit of work of
+# worker processes, see `_scan_gpx`.
+_CHUNK_POINTS = 4096
+
+
+class _Stats(object):
+    """
+        Counters and time (in seconds) spent in each stage of a component
+        created with `stats`, not counting the stages nested in it. Stages are
+        timed by wrapping their methods with `timed`.
+    """
+
+    # Statistics of the components of this process, by name, for the `stats`
+    # query.
+    by_name = dict()
+
+    def __init__(self, name):
+        self.counters = collections.Counter()
+        self.times = collections.defaultdict(float)
+        self._nested_time = 0.0
+        _Stats.by_name[name] = self
+
+    def timed(self, stage, function):
+        def _timed(*args, **kwargs):
+            (outer_nested_time, self._nested_time) = (self._nested_time, 0.0)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.times[stage] += elapsed - self._nested_time
+                self._nested_time = outer_nested_time + elapsed
+
+        return _timed
+
+    def timed_iter(self, stage, iterator):
+        # Same as `timed`, for getting each item of `iterator`.
+        end = object()
+        timed_next = self.timed(stage, functools.partial(next, iter(iterator), end))
+        return iter(timed_next, end)
+
+    def to_dict(self):
+        return {"counters": dict(self.counters), "times": dict(self.times)}
+
+    def dump(self, name):
+        print(
+            "STATS: {}: {}".format(name, json.dumps(self.to_dict(), sort_keys=True)),
+            file=sys.stderr,
+        )
+
+    @staticmethod
+    def query(params):
+        # The statistics of the component named by the `component` parameter,
+        # or of every component.
+        if params is None or "component" not in params:
+            return {name: s.to_dict() for (name, s) in _Stats.by_name.items()}
+
+        name = str(params["component"])
+        if name not in _Stats.by_name:
+            raise ValueError("GpxSource: no statistics for component `{}`".format(name))
+
+        return _Stats.by_name[name].to_dict()
+
+
+@functools.lru_cache(maxsize=1024)
+def _day_to_seconds(day):
+    # Seconds from the Unix epoch to the start of `day` (`YYYY-MM-DD`, UTC).
+    # Points of a track share a handful of days, hence the cache.
+    return (date.fromisoformat(day).toordinal() - _EPOCH_ORDINAL) * 86400
+
+
+def _parse_time(text):
+    # Convert a gpx time to nanoseconds from the Unix epoch. The usual
+    # `YYYY-MM-DDTHH:MM:SS[.fraction]Z` form is parsed directly, anything
+    # else goes through `datetime`.
+    if (
+        len(text) >= 20
+        and text[10] == "T"
+        and text[13] == ":"
+        and text[16] == ":"
+        and text[-1] == "Z"
+        and (len(text) == 20 or text[19] == ".")
+    ):
+        seconds = (
+            _day_to_seconds(text[:10])
+            + int(text[11:13]) * 3600
+            + int(text[14:16]) * 60
+            + int(text[17:19])
+        )
+        ns = seconds * 1000000000
+
+        if len(text) > 20:
+            ns += int(text[20:-1][:9].ljust(9, "0"))
+
+        return ns
+
+    time = datetime.fromisoformat(text.replace("Z", "+00:00"))
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+
+    return calendar.timegm(time.utctimetuple()) * 1000000000 + time.microsecond * 1000
+
+
+def _iterparse_gpx(path, headers=(), offset=0, counters=None):
+    # Stream the elements of a gpx file as they are completed, yielding
+    # ("start", elem) and ("end", elem) pairs. Once a child of `gpx`, `trk`,
+    # `trkseg` or `rte` is completed and handed to the caller, it is removed
+    # from its parent, so that memory use doesn't grow with the length of the
+    # file.
+    #
+    # To read a part of the file without parsing what comes before it, give
+    # the byte `offset` of its first element and the (begin, end) byte ranges
+    # `headers` of the start tags of the elements enclosing it, see
+    # `_scan_gpx`. The bytes read are counted in `counters`, when given.
+    parser = etree.XMLPullParser(events=("start", "end"))
+    parents = []
+
+    with open(path, "rb") as f:
+        for (begin, end) in headers:
+            f.seek(begin)
+            parser.feed(f.read(end - begin))
+
+        f.seek(offset)
+        while True:
+            data = f.read(_READ_SIZE)
+            if counters is not None:
+                counters["bytes-read"] += len(data)
+
+            if len(data) > 0:
+                parser.feed(data)
+            else:
+                parser.close()
+
+            for (event, elem) in parser.read_events():
+                if event == "start":
+                    if len(parents) == 0 and elem.tag != _GPX_TAG:
+                        raise ValueError("GpxSource: {} is not a gpx file".format(path))
+
+                    parents.append(elem)
+                    yield (event, elem)
+                else:
+                    parents.pop()
+                    yield (event, elem)
+
+                    if len(parents) > 0 and parents[-1].tag in (
+                        _GPX_TAG,
+                        _TRK_TAG,
+                        _TRKSEG_TAG,
+                        _RTE_TAG,
+                    ):
+                        parents[-1].remove(elem)
+
+            if len(data) == 0:
+                return
+
+
+def _scan_gpx(path, split_segments):
+    # Return the number of segments of each track, the number of routes, the
+    # number of waypoints and the chunks of the points of each port of a gpx
+    # file, by port (kind, index, segment), see `_iter_ports`.
+    #
+    # A chunk is a [headers, offset, count] list locating `count` consecutive
+    # points, at most `_CHUNK_POINTS`, for `_iterparse_gpx`: `offset` is the
+    # byte offset of the first one and `headers` are the byte ranges of the
+    # start tags of the elements enclosing it. The start tag of an element
+    # ends, as far as parsing is concerned, where its first child begins.
+    # The one of the root element also includes the prolog of the file.
+    #
+    # Only the start of elements matter here, so this uses expat directly
+    # rather than building elements.
+    parser = expat.ParserCreate(namespace_separator="}")
+    trk_segments = []
+    rte_count = 0
+    wpt_count = 0
+    port_chunks = dict()
+
+    # [tag, begin, first child offset] of the elements enclosing the current
+    # one, and the ports the points of the current track, segment and route
+    # are on.
+    stack = []
+    (trk_port, trkseg_port, rte_port) = (None, None, None)
+
+    def _add_point(port, offset):
+        chunks = port_chunks[port]
+        if len(chunks) == 0 or chunks[-1][2] == _CHUNK_POINTS:
+            headers = [(begin, first_child) for (_, begin, first_child) in stack]
+            chunks.append([headers, offset, 0])
+        chunks[-1][2] += 1
+
+    def _start(name, attrs):
+        nonlocal trk_port, trkseg_port, rte_port, rte_count, wpt_count
+
+        # Expat names are `URI}NAME`, etree tags `{URI}NAME`.
+        tag = "{" + name
+        offset = parser.CurrentByteIndex
+        if len(stack) == 0:
+            if tag != _GPX_TAG:
+                raise ValueError("GpxSource: {} is not a gpx file".format(path))
+
+            # The header of the root element starts with the prolog, which
+            # declares the encoding of the file.
+            offset = 0
+        elif stack[-1][2] is None:
+            stack[-1][2] = offset
+
+        if tag == _TRK_TAG:
+            trk_port = ("trk", len(trk_segments), None)
+            trk_segments.append(0)
+            if not split_segments:
+                port_chunks[trk_port] = []
+        elif tag == _TRKSEG_TAG and trk_port is not None:
+            trkseg_port = ("trk", trk_port[1], trk_segments[-1])
+            trk_segments[-1] += 1
+            if split_segments:
+                port_chunks[trkseg_port] = []
+        elif tag == _RTE_TAG:
+            rte_port = ("rte", rte_count, None)
+            rte_count += 1
+            port_chunks[rte_port] = []
+        elif tag == _TRKPT_TAG:
+            if split_segments and trkseg_port is not None:
+                _add_point(trkseg_port, offset)
+            elif not split_segments and trk_port is not None:
+                _add_point(trk_port, offset)
+        elif tag == _RTEPT_TAG and rte_port is not None:
+            _add_point(rte_port, offset)
+        elif tag == _WPT_TAG:
+            port_chunks.setdefault(("wpt", None, None), [])
+            _add_point(("wpt", None, None), offset)
+            wpt_count += 1
+
+        stack.append([tag, offset, None])
+
+    def _end(name):
+        nonlocal trk_port, trkseg_port, rte_port
+
+        tag = stack.pop()[0]
+        if tag == _TRK_TAG:
+            (trk_port, trkseg_port) = (None, None)
+        elif tag == _TRKSEG_TAG:
+            trkseg_port = None
+        elif tag == _RTE_TAG:
+            rte_port = None
+
+    parser.StartElementHandler = _start
+    parser.EndElementHandler = _end
+
+    with open(path, "rb") as f:
+        try:
+            parser.ParseFile(f)
+        except expat.ExpatError as exc:
+            raise ValueError("GpxSource: cannot parse {}: {}".format(path, exc))
+
+    return (trk_segments, rte_count, wpt_count, port_chunks)
+
+
+def _iter_point_elems(path, point_tag, chunk, counters=None):
+    # Yield the `point_tag` elements of a chunk of a gpx file, see
+    # `_scan_gpx`. Each element is only valid until the next one is
+    # requested.
+    (headers, offset, count) = chunk
+
+    for (event, elem) in _iterparse_gpx(path, headers, offset, counters):
+        if event == "end" and elem.tag == point_tag:
+            yield elem
+
+            count -= 1
+            if count == 0:
+                return
+
+
+def _decode_point(elem):
+    # Return the (time, lat, lon, ele, name) of a point element, where time
+    # is `None` when the point has none.
+    lat = float(elem.attrib["lat"])
+    lon = float(elem.attrib["lon"])
+
+    # Single pass over the children rather than a `find` per child.
+    ele = float("nan")
+    ts = None
+    name = ""
+    for child in elem:
+        if child.tag == _ELE_TAG:
+            ele = float(child.text)
+        elif child.tag == _TIME_TAG:
+            ts = _parse_time(child.text)
+        elif child.tag == _NAME_TAG:
+            name = child.text or ""
+
+    return (ts, lat, lon, ele, name)
+
+
+def _iter_points(path, point_tag, chunks, counters=None):
+    # Decode the `point_tag` points of `chunks`, as they are read.
+    for chunk in chunks:
+        for elem in _iter_point_elems(path, point_tag, chunk, counters):
+            yield _decode_point(elem)
+
+
+def _decode_points(path, point_tag, chunk):
+    # Return the decoded points of a chunk and the number of bytes read to
+    # decode them. This runs in a worker process when GpxSource is given
+    # `jobs`.
+    counters = collections.Counter()
+    points = list(_iter_points(path, point_tag, [chunk], counters))
+
+    return (points, counters["bytes-read"])
+
+
+def _expand_inputs(paths):
+    # Replace the directories of `paths` by the gpx files they contain, at any
+    # depth.
+    expanded = []
+    for path in paths:
+        if not os.path.isdir(path):
+            expanded.append(path)
+            continue
+
+        names = (
+            os.path.join(directory, name)
+            for (directory, _, names) in os.walk(path)
+            for name in names
+            if name.endswith(".gpx")
+        )
+        expanded.extend(sorted(names))
+
+    return expanded
+
+
+def _iter_ports(input, trk_segments, rte_count, wpt_count, split_segments):
+    # Yield the (name, kind, index, segment) of the ports of a gpx file:
+    #
+    #   - "trk": track number `index`, only its segment number `segment`
+    #     unless it is `None`,
+    #   - "rte": route number `index`,
+    #   - "wpt": all the waypoints.
+    for (trk_index, segment_count) in enumerate(trk_segments):
+        if split_segments:
+            for segment in range(segment_count):
+                name = "{}:trk{}:seg{}".format(input, trk_index, segment)
+                yield (name, "trk", trk_index, segment)
+        else:
+            yield ("{}:trk{}".format(input, trk_index), "trk", trk_index, None)
+
+    for rte_index in range(rte_count):
+        yield ("{}:rte{}".format(input, rte_index), "rte", rte_index, None)
+
+    if wpt_count > 0:
+        yield ("{}:wpt".format(input), "wpt", None, None)
+
+
+# Version of the summaries stored in trace info sidecars, to bump whenever
+# they change.
+_TRACE_INFO_VERSION = 1
+
+
+def _read_trace_info(path):
+    # Return the summary saved in the `<file>.info.json` sidecar of the gpx
+    # file at `path`, or `None` if the sidecar doesn't match the file.
+    try:
+        stat = os.stat(path)
+        with open("{}.info.json".format(path)) as f:
+            (key, summary) = json.load(f)
+    except (OSError, ValueError, TypeError):
+        return None
+
+    if key != [_TRACE_INFO_VERSION, stat.st_size, stat.st_mtime_ns]:
+        return None
+
+    return summary
+
+
+def _write_trace_info(path, stat, summary):
+    # A sidecar that can't be written, or is only partly written, is simply
+    # not used by `_read_trace_info`.
+    key = [_TRACE_INFO_VERSION, stat.st_size, stat.st_mtime_ns]
+    try:
+        with open("{}.info.json".format(path), "w") as f:
+            json.dump([key, summary], f)
+    except OSError:
+        pass
+
+
+def _summarize_gpx(path):
+    # Return the summary of a gpx file, after saving it to its sidecar: the
+    # number of points of each event class and, for each track segment, route
+    # and for the waypoints, the number of points, the first and last times of
+    # the points with a time, and whether a point without a time comes before
+    # them. This runs in a worker process when several files are summarized.
+    if not os.path.isfile(path):
+        raise ValueError("GpxSource: {} is not a file".format(path))
+
+    # The sidecar is keyed by the file status from before the parsing.
+    stat = os.stat(path)
+
+    def _new_stream():
+        return {"events": 0, "begin": None, "end": None, "leading-untimed": False}
+
+    summary = {
+        "event-classes": {"trkpt": 0, "rtept": 0, "wpt": 0},
+        "trk": [],
+        "rte": [],
+        "wpt": _new_stream(),
+    }
+    stream = None
+
+    for (event, elem) in _iterparse_gpx(path):
+        if event == "start":
+            if elem.tag == _TRK_TAG:
+                summary["trk"].append([])
+            elif elem.tag == _TRKSEG_TAG:
+                stream = _new_stream()
+                summary["trk"][-1].append(stream)
+            elif elem.tag == _RTE_TAG:
+                stream = _new_stream()
+                summary["rte"].append(stream)
+
+            continue
+
+        if elem.tag == _TRKPT_TAG:
+            (point_stream, point) = (stream, "trkpt")
+        elif elem.tag == _RTEPT_TAG:
+            (point_stream, point) = (stream, "rtept")
+        elif elem.tag == _WPT_TAG:
+            (point_stream, point) = (summary["wpt"], "wpt")
+        else:
+            continue
+
+        summary["event-classes"][point] += 1
+        point_stream["events"] += 1
+
+        time_elem = elem.find(_TIME_TAG)
+        if time_elem is None:
+            if point_stream["begin"] is None:
+                point_stream["leading-untimed"] = True
+            continue
+
+        ts = _parse_time(time_elem.text)
+        if point_stream["begin"] is None:
+            (point_stream["begin"], point_stream["end"]) = (ts, ts)
+        else:
+            point_stream["begin"] = min(point_stream["begin"], ts)
+            point_stream["end"] = max(point_stream["end"], ts)
+
+    _write_trace_info(path, stat, summary)
+
+    return summary
+
+
+def _get_stream_range(streams):
+    # Return the (begin, end) times of a port made of the points of the
+    # `streams` summaries, or `None` if it has no points. Points without a
+    # time take the one of the previous point, or 0 for the first ones.
+    (begin, end) = (None, None)
+    timed = False
+
+    for stream in streams:
+        times = []
+        if stream["events"] > 0 and stream["leading-untimed"] and not timed:
+            times.append(0)
+        if stream["begin"] is not None:
+            times += [stream["begin"], stream["end"]]
+            timed = True
+
+        for ts in times:
+            begin = ts if begin is None else min(begin, ts)
+            end = ts if end is None else max(end, ts)
+
+    if begin is None:
+        return None
+
+    return (begin, end)
+
+
+def _get_gpx_summaries(paths):
+    # Return the summary of each gpx file of `paths`, from their sidecars when
+    # they are up to date. The others are summarized by worker processes.
+    summaries = {path: _read_trace_info(path) for path in paths}
+    missing = [path for (path, summary) in summaries.items() if summary is None]
+
+    if len(missing) > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+            mp_context=multiprocessing.get_context("fork")
+        ) as pool:
+            for (path, summary) in zip(missing, pool.map(_summarize_gpx, missing)):
+                summaries[path] = summary
+    else:
+        for path in missing:
+            summaries[path] = _summarize_gpx(path)
+
+    return summaries
 
 
 class GpxIter(bt2._UserMessageIterator):
     def __init__(self, config, port):
         print("GpxIter: Creating for port {}".format(port))
-        self._trk_elem, self._trace_class = port.user_data
+        (
+            self._path,
+            self._kind,
+            chunks,
+            self._event_class,
+            pool,
+            jobs,
+            stats,
+        ) = port.user_data
+
+        stream_class = self._event_class.stream_class
+        self._trace = stream_class.trace_class()
+        self._stream = self._trace.create_stream(stream_class)
+        self._payload_names = list(self._event_class.payload_field_class.keys())
+
+        # With a pool, the chunks of points are decoded ahead by worker
+        # processes while the other ports are being consumed, see
+        # `_iter_pool_points`. Otherwise, they are decoded as they are read.
+        point_tag = _POINT_TAGS[self._kind]
+        counters = None if stats is None else stats.counters
+        if pool is not None:
+            self._points = self._iter_pool_points(
+                pool, jobs, point_tag, chunks, counters
+            )
+        else:
+            self._points = _iter_points(self._path, point_tag, chunks, counters)
+
+        self._stats = stats
+        if stats is not None:
+            self._instrument(stats)
 
-        self._trace = self._trace_class()
+        self._msgs = self._generate_msgs()
 
-        self._trk_stream_class = self._trace_class[0]
-        assert self._trk_stream_class.name == "trk"
-        self._trk_stream = self._trace.create_stream(self._trk_stream_class)
+    def _iter_pool_points(self, pool, jobs, point_tag, chunks, counters):
+        # Decode the chunks by the worker processes of `pool`, keeping `jobs`
+        # of them ahead, so that the decoded points waiting to be read stay
+        # bounded. The first ones are submitted right away.
+        chunks = iter(chunks)
+        futures = collections.deque()
 
-        self._trkpt_event_class = self._trk_stream_class[0]
-        assert self._trkpt_event_class.name == "trkpt"
+        def _submit(count):
+            for chunk in itertools.islice(chunks, count):
+                futures.append(
+                    pool.submit(_decode_points, self._path, point_tag, chunk)
+                )
 
-        self._init_msgs = [self._create_stream_beginning_message(self._trk_stream)]
+        def _points():
+            while len(futures) > 0:
+                (points, bytes_read) = futures.popleft().result()
+                _submit(1)
 
-        self._end_msgs = [self._create_stream_end_message(self._trk_stream)]
+                if counters is not None:
+                    counters["bytes-read"] += bytes_read
 
-        self._trkpt_iter = self._trk_elem.iter(
-            "{http://www.topografix.com/GPX/1/1}trkpt"
-        )
+                yield from points
 
-        self._next = self._next_init
+        _submit(jobs)
 
-    def _next_init(self):
-        if len(self._init_msgs) > 0:
-            return self._init_msgs.pop(0)
-        else:
-            self._next = self._next_events
-            return self._next()
+        return _points()
 
-    def _next_events(self):
-        try:
-            trkpt = next(self._trkpt_iter)
+    def _instrument(self, stats):
+        # Count and time the stages of the hot path by wrapping the methods
+        # doing them. With `jobs`, points are decoded by worker processes and
+        # reading them is waiting for these.
+        self._points = stats.timed_iter("read", self._points)
 
-            lat = float(trkpt.attrib["lat"])
-            lon = float(trkpt.attrib["lon"])
-            ele_elem = trkpt.find("{http://www.topografix.com/GPX/1/1}ele")
-            ele = float(ele_elem.text)
+        # Creating an event is creating its message, then assigning its
+        # payload fields.
+        create_event_message = stats.timed("create", self._create_event_message)
 
-            time_elem = trkpt.find("{http://www.topografix.com/GPX/1/1}time")
-            time = datetime.strptime(time_elem.text, "%Y-%m-%dT%H:%M:%SZ")
-            ts = int(datetime.timestamp(time))
+        def _create_event_message(event_class, *args, **kwargs):
+            stats.counters["events.{}".format(event_class.name)] += 1
+            return create_event_message(event_class, *args, **kwargs)
 
-            event_msg = self._create_event_message(
-                self._trkpt_event_class, self._trk_stream, default_clock_snapshot=ts
-            )
-            event_msg.event.payload_field["lat"] = lat
-            event_msg.event.payload_field["lon"] = lon
-            event_msg.event.payload_field["ele"] = ele
-            return event_msg
-        except StopIteration:
-            self._next = self._next_end
-            return self._next()
-
-    def _next_end(self):
-        if len(self._end_msgs) > 0:
-            return self._end_msgs.pop(0)
-        else:
-            raise StopIteration
+        self._create_event_message = _create_event_message
+        self._create_point_event = stats.timed("assign", self._create_point_event)
+
+    def _iter_timed_points(self):
+        # Points without a time get the one of the previous point (0 for the
+        # first point).
+        ts = 0
+
+        for point in self._points:
+            if point[0] is None:
+                point = (ts,) + point[1:]
+            ts = point[0]
+            yield point
+
+    def _generate_msgs(self):
+        # All the messages of the iterator are produced by this generator, so
+        # that each call to `__next__` only resumes it.
+        create_point_event = self._create_point_event
+
+        yield self._create_stream_beginning_message(self._stream)
+
+        # Waypoints, which are not recorded in order, are sorted by time.
+        points = self._iter_timed_points()
+        if self._kind == "wpt":
+            points = sorted(points, key=lambda point: point[0])
+
+        for point in points:
+            yield create_point_event(point)
+
+        yield self._create_stream_end_message(self._stream)
+
+    def _create_point_event(self, point):
+        event_msg = self._create_event_message(
+            self._event_class, self._stream, default_clock_snapshot=point[0]
+        )
+        payload_field = event_msg.event.payload_field
+        for (name, value) in zip(self._payload_names, point[1:]):
+            payload_field[name] = value
+        return event_msg
 
     def __next__(self):
-        return self._next()
+        return next(self._msgs)
 
 
 @bt2.plugin_component_class
@@ -86,61 +663,147 @@ class GpxSource(bt2._UserSourceComponent, message_iterator_class=GpxIter):
                 )
             )
 
-        if len(inputs) != 1:
+        if len(inputs) == 0:
             raise ValueError(
-                "GpxSource: expecting `inputs` parameter to be of length, got {}".format(
-                    len(inputs)
-                )
+                "GpxSource: expecting `inputs` parameter to not be of length zero"
             )
 
-        if type(inputs[0]) != bt2._StringValueConst:
-            raise TypeError(
-                "GpxSource: expecting `inputs[0]` parameter to be a string, got a {}".format(
-                    type(inputs[0])
+        for (i, input) in enumerate(inputs):
+            if type(input) != bt2._StringValueConst:
+                raise TypeError(
+                    "GpxSource: expecting `inputs[{}]` parameter to be a string, got a {}".format(
+                        i, type(input)
+                    )
                 )
-            )
 
-        trace_class = self._create_metadata()
+        split_segments = False
+        if "split-segments" in params:
+            if type(params["split-segments"]) != bt2._BoolValueConst:
+                raise TypeError(
+                    "GpxSource: expecting `split-segments` parameter to be a boolean, got a {}".format(
+                        type(params["split-segments"])
+                    )
+                )
+            split_segments = bool(params["split-segments"])
+
+        # With `jobs`, every port is decoded ahead by a pool of worker
+        # processes.
+        self._pool = None
+        self._jobs = 0
+        if "jobs" in params:
+            if type(params["jobs"]) not in [
+                bt2._SignedIntegerValueConst,
+                bt2._UnsignedIntegerValueConst,
+            ]:
+                raise TypeError(
+                    "GpxSource: expecting `jobs` parameter to be an integer, got a {}".format(
+                        type(params["jobs"])
+                    )
+                )
 
-        self._create_ports_for_file(str(inputs[0]), trace_class)
+            self._jobs = int(params["jobs"])
+            if self._jobs > 0:
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self._jobs,
+                    mp_context=multiprocessing.get_context("fork"),
+                )
 
-    def _create_metadata(self):
-        clock_class = self._create_clock_class(frequency=1)
-        trace_class = self._create_trace_class()
+        # With `stats`, the iterators count events and time their stages, see
+        # `_Stats`.
+        self._stats = None
+        if "stats" in params:
+            if type(params["stats"]) != bt2._BoolValueConst:
+                raise TypeError(
+                    "GpxSource: expecting `stats` parameter to be a boolean, got a {}".format(
+                        type(params["stats"])
+                    )
+                )
 
-        sc = trace_class.create_stream_class(
-            name="trk", default_clock_class=clock_class
-        )
+            if params["stats"]:
+                self._stats = _Stats(self.name)
+
+        self._create_metadata()
+
+        for input in _expand_inputs([str(input) for input in inputs]):
+            self._create_ports_for_file(input, split_segments)
 
-        # 'trkpt' event
-        trkpt_payload = trace_class.create_structure_field_class()
-        trkpt_payload.append_member(
+    def _user_finalize(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+        if self._stats is not None:
+            self._stats.dump(self.name)
+
+    @staticmethod
+    def _create_point_payload(trace_class, with_name):
+        payload = trace_class.create_structure_field_class()
+        payload.append_member(
             "lat", trace_class.create_double_precision_real_field_class()
         )
-        trkpt_payload.append_member(
+        payload.append_member(
             "lon", trace_class.create_double_precision_real_field_class()
         )
-        trkpt_payload.append_member(
+        payload.append_member(
             "ele", trace_class.create_double_precision_real_field_class()
         )
-        sc.create_event_class(name="trkpt", payload_field_class=trkpt_payload)
+        if with_name:
+            payload.append_member("name", trace_class.create_string_field_class())
+
+        return payload
+
+    def _create_metadata(self):
+        # Nanosecond resolution, gpx times may have fractional seconds.
+        clock_class = self._create_clock_class(
+            frequency=1000000000, origin_is_unix_epoch=True
+        )
+        trace_class = self._create_trace_class()
 
         print("GpxSource: Created trace class", trace_class)
-        print("GpxSource:     with stream class trk", trace_class[0])
-        print("GpxSource:     with event class trkpt", trace_class[0][0])
 
-        return trace_class
+        # One stream class, with a single event class, per kind of point.
+        self._event_classes = dict()
+        for (kind, point) in [("trk", "trkpt"), ("rte", "rtept"), ("wpt", "wpt")]:
+            sc = trace_class.create_stream_class(
+                name=kind, default_clock_class=clock_class
+            )
+            payload = GpxSource._create_point_payload(trace_class, kind != "trk")
+            self._event_classes[kind] = sc.create_event_class(
+                name=point, payload_field_class=payload
+            )
+
+            print("GpxSource:     with stream class", kind, sc)
+            print("GpxSource:     with event class", point, self._event_classes[kind])
+
+    def _add_point_port(self, name, input, kind, chunks):
+        print("GpxSource: Adding output port", name)
+        self._add_output_port(
+            name,
+            (
+                input,
+                kind,
+                chunks,
+                self._event_classes[kind],
+                self._pool,
+                self._jobs,
+                self._stats,
+            ),
+        )
 
-    def _create_ports_for_file(self, input, trace_class):
+    def _create_ports_for_file(self, input, split_segments):
         if not os.path.isfile(input):
             raise ValueError("GpxSource: {} is not a file".format(input))
 
-        tree = etree.parse(input)
-        assert tree.getroot().tag == "{http://www.topografix.com/GPX/1/1}gpx"
+        # Only scan the file here: each message iterator streams its own
+        # points from where they are in the file, so the file is never
+        # entirely in memory, nor parsed again by each port.
+        (trk_segments, rte_count, wpt_count, port_chunks) = _scan_gpx(
+            input, split_segments
+        )
 
-        for trk in tree.findall("{http://www.topografix.com/GPX/1/1}trk"):
-            print("GpxSource: Adding output port for track", trk)
-            self._add_output_port("out", (trk, trace_class))
+        for (name, kind, index, segment) in _iter_ports(
+            input, trk_segments, rte_count, wpt_count, split_segments
+        ):
+            self._add_point_port(name, input, kind, port_chunks[(kind, index, segment)])
 
     @staticmethod
     def _user_query(query_executor, obj, params, log_level):
@@ -151,9 +814,54 @@ class GpxSource(bt2._UserSourceComponent, message_iterator_class=GpxIter):
                 w = 0.0
 
             return {"weight": w}
+        elif obj == "babeltrace.trace-infos":
+            return GpxSource._query_trace_infos(params)
+        elif obj == "stats":
+            return _Stats.query(params)
         else:
             raise bt2.UnknownObject
 
+    @staticmethod
+    def _query_trace_infos(params):
+        # Each port has its own trace and stream, whose time range comes from
+        # the summary of its file.
+        if "inputs" not in params:
+            raise ValueError("GpxSource: missing `inputs` parameter")
+
+        inputs = _expand_inputs([str(input) for input in params["inputs"]])
+        split_segments = "split-segments" in params and bool(params["split-segments"])
+        summaries = _get_gpx_summaries(inputs)
+
+        trace_infos = []
+        for input in inputs:
+            summary = summaries[input]
+            for (name, kind, index, segment) in _iter_ports(
+                input,
+                [len(segments) for segments in summary["trk"]],
+                len(summary["rte"]),
+                summary["wpt"]["events"],
+                split_segments,
+            ):
+                if kind == "trk" and segment is None:
+                    port_streams = summary["trk"][index]
+                elif kind == "trk":
+                    port_streams = [summary["trk"][index][segment]]
+                elif kind == "rte":
+                    port_streams = [summary["rte"][index]]
+                else:
+                    port_streams = [summary["wpt"]]
+
+                stream_info = {"port-name": name}
+                time_range = _get_stream_range(port_streams)
+                if time_range is not None:
+                    stream_info["range-ns"] = {
+                        "begin": time_range[0],
+                        "end": time_range[1],
+                    }
+                trace_infos.append({"stream-infos": [stream_info]})
+
+        return trace_infos
+
 
 bt2.register_plugin(
     module_name=__name__,
@@ -1,7 +1,280 @@
 import bt2
-import bintrees
+import collections
+import concurrent.futures
 import itertools
-import matplotlib.pyplot as plt
+import json
+import multiprocessing
+import numpy
+import os
+import struct
+import sys
+import time
+from matplotlib.figure import Figure
+
+
+class _Stats(object):
+    """
+        Counters and time (in seconds) spent in each stage of a component
+        created with `stats`, not counting the stages nested in it. Stages are
+        timed by wrapping their methods with `timed`.
+    """
+
+    # Statistics of the components of this process, by name, for the `stats`
+    # query.
+    by_name = dict()
+
+    def __init__(self, name):
+        self.counters = collections.Counter()
+        self.times = collections.defaultdict(float)
+        self._nested_time = 0.0
+        _Stats.by_name[name] = self
+
+    def timed(self, stage, function):
+        def _timed(*args, **kwargs):
+            (outer_nested_time, self._nested_time) = (self._nested_time, 0.0)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.times[stage] += elapsed - self._nested_time
+                self._nested_time = outer_nested_time + elapsed
+
+        return _timed
+
+    def to_dict(self):
+        return {"counters": dict(self.counters), "times": dict(self.times)}
+
+    def dump(self, name):
+        print(
+            f"STATS: {name}: {json.dumps(self.to_dict(), sort_keys=True)}",
+            file=sys.stderr,
+        )
+
+    @staticmethod
+    def query(params):
+        # The statistics of the component named by the `component` parameter,
+        # or of every component.
+        if params is None or "component" not in params:
+            return {name: s.to_dict() for (name, s) in _Stats.by_name.items()}
+
+        name = str(params["component"])
+        if name not in _Stats.by_name:
+            raise ValueError(f"PlotSink: no statistics for component `{name}`")
+
+        return _Stats.by_name[name].to_dict()
+
+
+class GrowableArray(object):
+    """
+        This class is an append-only typed array, growing its storage
+        geometrically. Its content is available as a NumPy array without
+        copying it.
+    """
+
+    def __init__(self, dtype, capacity=1024):
+        self._data = numpy.empty(capacity, dtype=dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, value):
+        if self._size == len(self._data):
+            self._grow(self._size + 1)
+
+        self._data[self._size] = value
+        self._size += 1
+
+    def extend(self, values):
+        size = self._size + len(values)
+        if size > len(self._data):
+            self._grow(size)
+
+        self._data[self._size : size] = values
+        self._size = size
+
+    def _grow(self, size):
+        data = numpy.empty(max(2 * len(self._data), size), dtype=self._data.dtype)
+        data[: self._size] = self._data[: self._size]
+        self._data = data
+
+    def get_array(self):
+        return self._data[: self._size]
+
+
+class MinMaxDecimator(object):
+    """
+        This class downsamples a series of (ts, value) points, received in
+        timestamp order, as they arrive. Time is split in at most
+        `max_points / 2` buckets, of which only the minimum and maximum points
+        are kept, so memory use is bounded by the output resolution rather
+        than by the length of the series.
+
+        Buckets start one time unit wide. Whenever the series outgrows them,
+        their width is doubled by merging them two by two.
+    """
+
+    def __init__(self, max_points):
+        self._bucket_count = max(max_points // 2, 1)
+        self._width = 1
+        self._origin = None
+
+        # Non-empty buckets in time order, as lists of
+        # [index, min ts, min value, max ts, max value].
+        self._buckets = []
+
+    def append(self, ts, value):
+        # A NaN is neither a minimum nor a maximum.
+        if value != value:
+            return
+
+        if self._origin is None:
+            self._origin = ts
+
+        index = (ts - self._origin) // self._width
+        while index >= self._bucket_count:
+            self._merge()
+            index = (ts - self._origin) // self._width
+
+        if len(self._buckets) > 0 and self._buckets[-1][0] == index:
+            bucket = self._buckets[-1]
+            if value < bucket[2]:
+                bucket[1] = ts
+                bucket[2] = value
+            if value > bucket[4]:
+                bucket[3] = ts
+                bucket[4] = value
+        else:
+            self._buckets.append([index, ts, value, ts, value])
+
+    def _merge(self):
+        self._width *= 2
+
+        buckets = []
+        for bucket in self._buckets:
+            index = bucket[0] // 2
+            if len(buckets) > 0 and buckets[-1][0] == index:
+                merged = buckets[-1]
+                if bucket[2] < merged[2]:
+                    merged[1:3] = bucket[1:3]
+                if bucket[4] > merged[4]:
+                    merged[3:5] = bucket[3:5]
+            else:
+                bucket[0] = index
+                buckets.append(bucket)
+
+        self._buckets = buckets
+
+    def get_data(self):
+        """
+            Returns the timestamps and values of the kept points, in timestamp
+            order.
+        """
+        timestamps = []
+        values = []
+
+        for (index, min_ts, min_value, max_ts, max_value) in self._buckets:
+            if min_ts == max_ts:
+                timestamps.append(min_ts)
+                values.append(min_value)
+            elif min_ts < max_ts:
+                timestamps.extend((min_ts, max_ts))
+                values.extend((min_value, max_value))
+            else:
+                timestamps.extend((max_ts, min_ts))
+                values.extend((max_value, min_value))
+
+        return (
+            numpy.array(timestamps, dtype=numpy.int64),
+            numpy.array(values, dtype=numpy.float64),
+        )
+
+
+class P2Quantile(object):
+    """
+        This class estimates a quantile of a series of values in constant
+        memory with the P² algorithm (Jain & Chlamtac, 1985): five markers
+        track the minimum, the maximum, the quantile and two points halfway,
+        and their heights are adjusted with a piecewise-parabolic formula as
+        values arrive.
+    """
+
+    def __init__(self, quantile):
+        self._quantile = quantile
+        self._heights = []
+        self._positions = [1, 2, 3, 4, 5]
+        self._desired = [
+            1,
+            1 + 2 * quantile,
+            1 + 4 * quantile,
+            3 + 2 * quantile,
+            5,
+        ]
+        self._increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    def append(self, value):
+        heights = self._heights
+        positions = self._positions
+
+        # The first five values are the initial marker heights.
+        if len(heights) < 5:
+            heights.append(value)
+            heights.sort()
+            return
+
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+
+        for i in range(1, 4):
+            delta = self._desired[i] - positions[i]
+            if (delta >= 1 and positions[i + 1] - positions[i] > 1) or (
+                delta <= -1 and positions[i - 1] - positions[i] < -1
+            ):
+                step = 1 if delta > 0 else -1
+                height = self._parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + step * (heights[i + step] - heights[i]) / (
+                        positions[i + step] - positions[i]
+                    )
+
+                heights[i] = height
+                positions[i] += step
+
+    def _parabolic(self, i, step):
+        heights = self._heights
+        positions = self._positions
+
+        return heights[i] + step / (positions[i + 1] - positions[i - 1]) * (
+            (positions[i] - positions[i - 1] + step)
+            * (heights[i + 1] - heights[i])
+            / (positions[i + 1] - positions[i])
+            + (positions[i + 1] - positions[i] - step)
+            * (heights[i] - heights[i - 1])
+            / (positions[i] - positions[i - 1])
+        )
+
+    def get_value(self):
+        if len(self._heights) < 5:
+            # Exact while there are too few values for the markers.
+            index = round(self._quantile * (len(self._heights) - 1))
+            return self._heights[index]
+
+        return self._heights[2]
 
 
 class DataLogger(object):
@@ -17,9 +290,36 @@ class DataLogger(object):
     def get_y_data(self):
         raise NotImplementedError
 
-    def received_event(self, ts, event):
+    def get_fields(self):
+        """
+            Returns the list of (event name, field name) this logger wants the
+            values of. `received_value` is then called with the index of the
+            field in this list. A `None` field name stands for the events
+            themselves, whose value is then `None`.
+        """
         raise NotImplementedError
 
+    def received_value(self, ts, index, value):
+        raise NotImplementedError
+
+    def pop_data(self):
+        """
+            Returns the X and Y data received since the last call and forgets
+            it, or `None` if the data of this logger is only final once all
+            the events are received.
+        """
+        return None
+
+    def received_event(self, ts, event):
+        for (index, (name, field)) in enumerate(self.get_fields()):
+            if event.name != name:
+                continue
+
+            if field is None:
+                self.received_value(ts, index, None)
+            elif field in event.payload_field:
+                self.received_value(ts, index, float(event.payload_field[field]))
+
 
 class TimedDataLogger(DataLogger):
     """
@@ -27,26 +327,61 @@ class TimedDataLogger(DataLogger):
         plotted.
     """
 
-    def __init__(self, data, *args, **kwargs):
+    def __init__(self, data, *args, max_points=None, **kwargs):
         super(TimedDataLogger, self).__init__(*args, **kwargs)
 
         (self._event, self._field) = data
 
-        self._timestamps = []
-        self._values = []
+        # With `max_points`, the data is downsampled as it is received.
+        if max_points is None:
+            self._decimator = None
+            self._timestamps = GrowableArray(numpy.int64)
+            self._values = GrowableArray(numpy.float64)
+        else:
+            self._decimator = MinMaxDecimator(max_points)
+            self._decimated_data = None
 
     def get_x_data(self):
-        return self._timestamps
+        if self._decimator is not None:
+            return self._get_decimated_data()[0]
+
+        return self._timestamps.get_array()
 
     def get_y_data(self):
-        return self._values
+        if self._decimator is not None:
+            return self._get_decimated_data()[1]
 
-    def received_event(self, ts, event):
-        if event.name == self._event and self._field in event.payload_field:
-            value = event.payload_field[self._field]
-            self._add_data_point(ts, value)
+        return self._values.get_array()
+
+    def _get_decimated_data(self):
+        if self._decimated_data is None:
+            self._decimated_data = self._decimator.get_data()
+
+        return self._decimated_data
+
+    def get_fields(self):
+        return [(self._event, self._field)]
+
+    def received_value(self, ts, index, value):
+        self._add_data_point(ts, value)
+
+    def pop_data(self):
+        # Downsampled data may change until the last event.
+        if self._decimator is not None:
+            return None
+
+        data = (self._timestamps.get_array(), self._values.get_array())
+        self._timestamps = GrowableArray(numpy.int64)
+        self._values = GrowableArray(numpy.float64)
+
+        return data
 
     def _add_data_point(self, ts, value):
+        if self._decimator is not None:
+            self._decimator.append(ts, value)
+            self._decimated_data = None
+            return
+
         self._timestamps.append(ts)
         self._values.append(value)
 
@@ -74,95 +409,271 @@ class InterpolatedDataLogger(DataLogger):
         (self._event1, self._field1) = data1
         (self._event2, self._field2) = data2
 
-        self._x_timestamps = []
-        self._x_values = []
-        self._x_needs_interpolation = dict()
-        self._x_received_values = bintrees.AVLTree()
+        # Received values of each set of data.
+        self._x_timestamps = GrowableArray(numpy.int64)
+        self._x_values = GrowableArray(numpy.float64)
+        self._y_timestamps = GrowableArray(numpy.int64)
+        self._y_values = GrowableArray(numpy.float64)
 
-        self._y_timestamps = []
-        self._y_values = []
-        self._y_needs_interpolation = dict()
-        self._y_received_values = bintrees.AVLTree()
+        # Timestamp of every plotted point, in order of reception, and whether
+        # it comes from a value of the X set of data.
+        self._timestamps = GrowableArray(numpy.int64)
+        self._from_x = GrowableArray(numpy.bool_)
+
+        self._x_data = None
+        self._y_data = None
 
     def get_x_data(self):
-        self._interpolate_x_data()
-        return self._x_values
+        if self._x_data is None:
+            self._x_data = self._interpolate(
+                self._x_timestamps, self._x_values, self._from_x.get_array()
+            )
+
+        return self._x_data
 
     def get_y_data(self):
-        self._interpolate_y_data()
-        return self._y_values
+        if self._y_data is None:
+            self._y_data = self._interpolate(
+                self._y_timestamps, self._y_values, ~self._from_x.get_array()
+            )
+
+        return self._y_data
+
+    def get_fields(self):
+        return [(self._event1, self._field1), (self._event2, self._field2)]
+
+    def received_value(self, ts, index, value):
+        self._add_data_point(ts, value, index == 0)
+
+    def _interpolate(self, received_timestamps, received_values, received):
+        # Interpolate the values of a set of data at the timestamp of every
+        # point in a single pass. Points which come from that set of data keep
+        # their received value. Timestamps are made relative to the first
+        # point to keep their precision once converted to floats.
+        timestamps = self._timestamps.get_array()
+        if len(timestamps) == 0:
+            return numpy.empty(0)
+
+        values = received_values.get_array()
+        if len(values) == 0:
+            return numpy.full(len(timestamps), numpy.nan)
+
+        # When several values share a timestamp, the last one wins.
+        xp = received_timestamps.get_array()
+        last = numpy.append(xp[1:] != xp[:-1], True)
+
+        data = numpy.interp(
+            timestamps - timestamps[0], xp[last] - timestamps[0], values[last]
+        )
+        data[received] = values
 
-    def received_event(self, ts, event):
-        if event.name == self._event1 and self._field1 in event.payload_field:
-            value = event.payload_field[self._field1]
-            self._add_x_data_point(ts, value)
+        return data
 
-        if event.name == self._event2 and self._field2 in event.payload_field:
-            value = event.payload_field[self._field2]
-            self._add_y_data_point(ts, value)
+    def _add_data_point(self, ts, value, from_x):
+        if from_x:
+            self._x_timestamps.append(ts)
+            self._x_values.append(value)
+        else:
+            self._y_timestamps.append(ts)
+            self._y_values.append(value)
 
-    def _interpolate(self, ts, received_values):
-        try:
-            (after_ts, after_value) = received_values.ceiling_item(ts)
-        except KeyError:
-            (before_ts, before_value) = received_values.floor_item(ts)
-            return before_value
+        self._timestamps.append(ts)
+        self._from_x.append(from_x)
 
-        try:
-            (before_ts, before_value) = received_values.floor_item(ts)
-        except KeyError:
-            return after_value
+        self._x_data = None
+        self._y_data = None
+
+
+class HistogramDataLogger(DataLogger):
+    """
+        This class counts the values of a field into `buckets` buckets of the
+        same width between `low` and `high`. Values out of this range are
+        ignored. Only the counts are kept in memory.
+    """
+
+    def __init__(self, data, low, high, buckets, *args, **kwargs):
+        super(HistogramDataLogger, self).__init__(*args, **kwargs)
 
-        if before_ts == after_ts:
-            return before_value
+        (self._event, self._field) = data
 
-        a = ts - before_ts
-        x = (after_value - before_value) / (after_ts - before_ts)
-        b = before_value
+        if not low < high or buckets < 1:
+            raise ValueError(
+                "HistogramDataLogger: expecting `low` < `high` and at least one bucket"
+            )
 
-        return a * x + b
+        self._low = low
+        self._high = high
+        self._scale = buckets / (high - low)
+        self._counts = numpy.zeros(buckets, dtype=numpy.int64)
 
-    def _interpolate_x(self, ts):
-        return self._interpolate(ts, self._x_received_values)
+    def get_x_data(self):
+        width = (self._high - self._low) / len(self._counts)
+        return self._low + width * (numpy.arange(len(self._counts)) + 0.5)
 
-    def _interpolate_y(self, ts):
-        return self._interpolate(ts, self._y_received_values)
+    def get_y_data(self):
+        return self._counts.copy()
 
-    def _interpolate_x_data(self):
-        for (index, interpolated_ts) in self._x_needs_interpolation.items():
-            interpolated_value = self._interpolate_x(interpolated_ts)
-            self._x_timestamps[index] = interpolated_ts
-            self._x_values[index] = interpolated_value
-        self._x_needs_interpolation.clear()
+    def get_fields(self):
+        return [(self._event, self._field)]
 
-    def _interpolate_y_data(self):
-        for (index, interpolated_ts) in self._y_needs_interpolation.items():
-            interpolated_value = self._interpolate_y(interpolated_ts)
-            self._y_timestamps[index] = interpolated_ts
-            self._y_values[index] = interpolated_value
-        self._y_needs_interpolation.clear()
+    def received_value(self, ts, index, value):
+        # NaN fails both comparisons.
+        if self._low <= value < self._high:
+            bucket = min(int((value - self._low) * self._scale), len(self._counts) - 1)
+            self._counts[bucket] += 1
 
-    def _add_x_data_point(self, ts, value):
-        self._x_timestamps.append(ts)
-        self._x_values.append(value)
-        self._x_received_values[ts] = value
 
-        self._interpolate_x_data()
+class WindowDataLogger(DataLogger):
+    """
+        This class splits time in consecutive windows of `width` clock cycles
+        and computes a statistic of the values of a field received in each of
+        them: `mean`, `min`, `max` or a percentile such as `p99`.
 
-        self._y_timestamps.append(None)
-        self._y_values.append(None)
-        self._y_needs_interpolation[len(self._y_timestamps) - 1] = ts
+        Only one point is kept per window, percentiles being estimated
+        with the P² algorithm. Windows without values are not plotted.
+    """
 
-    def _add_y_data_point(self, ts, value):
-        self._y_timestamps.append(ts)
-        self._y_values.append(value)
-        self._y_received_values[ts] = value
+    def __init__(self, data, width, stat, *args, **kwargs):
+        super(WindowDataLogger, self).__init__(*args, **kwargs)
 
-        self._interpolate_y_data()
+        (self._event, self._field) = data
 
-        self._x_timestamps.append(None)
-        self._x_values.append(None)
-        self._x_needs_interpolation[len(self._y_timestamps) - 1] = ts
+        if width < 1:
+            raise ValueError("WindowDataLogger: expecting a positive window width")
+
+        self._width = width
+        self._quantile = None
+        if stat.startswith("p"):
+            try:
+                self._quantile = float(stat[1:]) / 100
+            except ValueError:
+                pass
+
+            if self._quantile is None or not 0 <= self._quantile <= 1:
+                raise ValueError(f"WindowDataLogger: invalid percentile `{stat}`")
+        elif stat not in ["mean", "min", "max"]:
+            raise ValueError(
+                f"WindowDataLogger: expecting `mean`, `min`, `max` or `pNN`, got `{stat}`"
+            )
+
+        self._stat = stat
+
+        # Statistic of every completed window.
+        self._timestamps = GrowableArray(numpy.int64)
+        self._values = GrowableArray(numpy.float64)
+
+        # State of the current window.
+        self._window = None
+        self._count = 0
+        self._sum = 0.0
+        self._min = None
+        self._max = None
+        self._estimator = None
+
+    def get_x_data(self):
+        x = self._timestamps.get_array()
+        if self._count > 0:
+            x = numpy.append(x, self._window * self._width)
+
+        return x
+
+    def get_y_data(self):
+        y = self._values.get_array()
+        if self._count > 0:
+            y = numpy.append(y, self._get_stat())
+
+        return y
+
+    def get_fields(self):
+        return [(self._event, self._field)]
+
+    def received_value(self, ts, index, value):
+        if value != value:
+            return
+
+        window = ts // self._width
+        if window != self._window:
+            if self._count > 0:
+                self._timestamps.append(self._window * self._width)
+                self._values.append(self._get_stat())
+
+            self._window = window
+            self._count = 0
+            self._sum = 0.0
+            self._min = value
+            self._max = value
+            if self._quantile is not None:
+                self._estimator = P2Quantile(self._quantile)
+
+        self._count += 1
+        if self._stat == "mean":
+            self._sum += value
+        elif self._stat == "min":
+            self._min = min(self._min, value)
+        elif self._stat == "max":
+            self._max = max(self._max, value)
+        else:
+            self._estimator.append(value)
+
+    def _get_stat(self):
+        if self._stat == "mean":
+            return self._sum / self._count
+        elif self._stat == "min":
+            return self._min
+        elif self._stat == "max":
+            return self._max
+
+        return self._estimator.get_value()
+
+
+class RateDataLogger(DataLogger):
+    """
+        This class counts the events of a given name received in each
+        consecutive window of `width` clock cycles, from the first one to the
+        last one. Windows without events count as zero. Events are expected
+        in timestamp order: the ones before the first window are ignored.
+    """
+
+    def __init__(self, event, width, *args, **kwargs):
+        super(RateDataLogger, self).__init__(*args, **kwargs)
+
+        self._event = event
+
+        if width < 1:
+            raise ValueError("RateDataLogger: expecting a positive window width")
+
+        self._width = width
+        self._first_window = None
+        self._counts = GrowableArray(numpy.int64)
+
+    def get_x_data(self):
+        if self._first_window is None:
+            return numpy.empty(0, dtype=numpy.int64)
+
+        windows = numpy.arange(len(self._counts), dtype=numpy.int64)
+        return (self._first_window + windows) * self._width
+
+    def get_y_data(self):
+        return self._counts.get_array()
+
+    def get_fields(self):
+        # No field is needed, only the events.
+        return [(self._event, None)]
+
+    def received_value(self, ts, index, value):
+        window = ts // self._width
+        if self._first_window is None:
+            self._first_window = window
+
+        index = window - self._first_window
+        if index < 0:
+            return
+
+        if index >= len(self._counts):
+            count = index + 1 - len(self._counts)
+            self._counts.extend(numpy.zeros(count, dtype=numpy.int64))
+
+        self._counts.get_array()[index] += 1
 
 
 class Plot(object):
@@ -174,33 +685,184 @@ class Plot(object):
         self._x_label = x_label
         self._y_label = y_label
 
+        # Figure, axes and lines kept between renderings by `plot_live`.
+        self._live = None
+
+    def get_title(self):
+        return self._title
+
+    def get_loggers(self):
+        return self._loggers
+
     def received_event(self, ts, event):
         for logger in self._loggers:
             logger.received_event(ts, event)
 
-    def plot(self):
-        figure = plt.figure()
-        plt.title(self._title)
-        plt.xlabel(self._x_label, figure=figure)
-        plt.ylabel(self._y_label, figure=figure)
+    def get_render_args(self, format="pdf", dpi=None):
+        """
+            Returns the arguments of `render_plot` for this plot.
+        """
+        series = [
+            (logger.get_name(), logger.get_x_data(), logger.get_y_data())
+            for logger in self._loggers
+        ]
+
+        return (
+            Plot._format_filename(self._title, format),
+            self._title,
+            self._x_label,
+            self._y_label,
+            series,
+            dpi,
+        )
 
-        for logger in self._loggers:
-            x = logger.get_x_data()
-            y = logger.get_y_data()
-            (line,) = plt.plot(x, y, figure=figure)
-            line.set_label(logger.get_name())
+    def plot(self, format="pdf", dpi=None):
+        render_plot(*self.get_render_args(format, dpi))
 
-        figure.gca().legend()
-        plt.savefig(Plot._format_filename(self._title))
+    def plot_live(self, format="pdf", dpi=None):
+        """
+            Renders the data received so far. The figure is kept between calls
+            and only the data of its lines is updated.
+        """
+        (path, title, x_label, y_label, series, dpi) = self.get_render_args(format, dpi)
+
+        if self._live is None:
+            self._live = _create_figure(title, x_label, y_label, series)
+        else:
+            (figure, axes, lines) = self._live
+            for (line, (name, x, y)) in zip(lines, series):
+                line.set_data(x, y)
+            axes.relim()
+            axes.autoscale_view()
+
+        self._live[0].savefig(path, dpi=dpi)
 
     @staticmethod
-    def _format_filename(title):
+    def _format_filename(title, format="pdf"):
         title = title.lower()
         title = "".join("-" if not c.isalnum() else c for c in title)
         title = "".join(
             ["".join(j) if i != "-" else i for (i, j) in itertools.groupby(title)]
         )
-        return f"{title}.pdf"
+        return f"{title}.{format}"
+
+
+class NpyWriter(object):
+    """
+        This class writes (x, y) records to a NumPy `.npy` file in chunks, as
+        a one-dimensional structured array with `x` and `y` fields. The header
+        is written with room to spare and rewritten with the final number of
+        records when the file is closed. Closing it again does nothing.
+    """
+
+    _HEADER_SIZE = 128
+
+    def __init__(self, path):
+        self._file = open(path, "wb")
+        self._dtype = None
+        self._count = 0
+
+    def write(self, x, y):
+        # The type of the fields is the one of the first chunk.
+        if self._dtype is None:
+            self._dtype = numpy.dtype([("x", x.dtype), ("y", y.dtype)])
+            self._write_header()
+
+        records = numpy.empty(len(x), dtype=self._dtype)
+        records["x"] = x
+        records["y"] = y
+        self._file.write(records.tobytes())
+        self._count += len(records)
+
+    def close(self):
+        if self._file.closed:
+            return
+
+        if self._dtype is None:
+            self._dtype = numpy.dtype([("x", numpy.float64), ("y", numpy.float64)])
+
+        self._write_header()
+        self._file.close()
+
+    def _write_header(self):
+        header = repr(
+            {
+                "descr": numpy.lib.format.dtype_to_descr(self._dtype),
+                "fortran_order": False,
+                "shape": (self._count,),
+            }
+        )
+
+        # Magic string, version and header length, then the header itself,
+        # padded with spaces and terminated by a newline.
+        preamble = numpy.lib.format.magic(1, 0) + struct.pack(
+            "<H", self._HEADER_SIZE - 10
+        )
+        header = header.ljust(self._HEADER_SIZE - 11) + "\n"
+        if len(preamble) + len(header) != self._HEADER_SIZE:
+            raise ValueError("NpyWriter: header too long")
+
+        self._file.seek(0)
+        self._file.write(preamble + header.encode("latin1"))
+        self._file.seek(0, os.SEEK_END)
+
+
+def _create_figure(title, x_label, y_label, series):
+    # This uses the object-oriented API of matplotlib rather than the pyplot
+    # state machine: the figure isn't registered anywhere and is freed once
+    # unused, and plots can be rendered in parallel by worker processes.
+    figure = Figure()
+    axes = figure.add_subplot()
+    axes.set_title(title)
+    axes.set_xlabel(x_label)
+    axes.set_ylabel(y_label)
+
+    lines = []
+    for (name, x, y) in series:
+        (line,) = axes.plot(x, y)
+        line.set_label(name)
+        lines.append(line)
+
+    axes.legend()
+
+    return (figure, axes, lines)
+
+
+def render_plot(path, title, x_label, y_label, series, dpi):
+    # The backend is chosen from the extension of `path`.
+    (figure, axes, lines) = _create_figure(title, x_label, y_label, series)
+    figure.savefig(path, dpi=dpi)
+
+
+# Plots of a worker process, see `_init_render_worker`.
+_worker_plots = None
+
+
+def _init_render_worker(plots):
+    # Worker processes are forked, so the plots and their data are inherited
+    # rather than pickled.
+    global _worker_plots
+
+    _worker_plots = plots
+
+
+def _render_worker_plot(index, format, dpi):
+    _worker_plots[index].plot(format, dpi)
+
+
+def get_dispatch(loggers, event):
+    # Returns the list of (field name, [(logger, index)]) of the event fields
+    # wanted by `loggers`, with `index` the one of the field for the logger.
+    targets = dict()
+    for logger in loggers:
+        for (index, (name, field)) in enumerate(logger.get_fields()):
+            if event.name != name:
+                continue
+
+            if field is None or field in event.payload_field:
+                targets.setdefault(field, []).append((logger, index))
+
+    return list(targets.items())
 
 
 @bt2.plugin_component_class
@@ -208,43 +870,180 @@ class PlotSink(bt2._UserSinkComponent):
     def __init__(self, config, params, obj):
         self._plots = []
 
+        max_points = None
+        if "max-points" in params:
+            max_points = int(params["max-points"])
+            if max_points < 2:
+                raise ValueError("PlotSink: expecting `max-points` to be at least 2")
+
         for plot in params["plots"]:
-            self._plots.append(PlotSink.create_plot(plot))
+            self._plots.append(PlotSink.create_plot(plot, max_points))
+
+        self._format = "pdf"
+        if "format" in params:
+            self._format = str(params["format"])
+            if self._format not in ["pdf", "png", "svg"]:
+                raise ValueError(
+                    f"PlotSink: expecting `format` to be `pdf`, `png` or `svg`, got `{self._format}`"
+                )
+
+        self._dpi = None
+        if "dpi" in params:
+            self._dpi = int(params["dpi"])
+            if self._dpi < 1:
+                raise ValueError("PlotSink: expecting `dpi` to be at least 1")
+
+        # With more than one job, plots are rendered by this many forked
+        # worker processes.
+        self._jobs = 1
+        if "jobs" in params:
+            self._jobs = int(params["jobs"])
+            if self._jobs < 1:
+                raise ValueError("PlotSink: expecting `jobs` to be at least 1")
+
+        # In live mode, plots are rendered with the data received so far every
+        # `live-interval` seconds and/or every `live-events` events.
+        self._live_interval = None
+        if "live-interval" in params:
+            self._live_interval = float(params["live-interval"])
+            if self._live_interval <= 0:
+                raise ValueError("PlotSink: expecting `live-interval` to be positive")
+
+        self._live_events = None
+        if "live-events" in params:
+            self._live_events = int(params["live-events"])
+            if self._live_events < 1:
+                raise ValueError("PlotSink: expecting `live-events` to be at least 1")
+
+        self._live_time = time.monotonic()
+        self._event_count = 0
+
+        # Event class address to the list of (field name, [(logger, index)])
+        # to dispatch its events to, see `_get_dispatch`.
+        self._dispatch = dict()
+
+        # With `stats`, events are counted and the time spent by each logger
+        # and in rendering is measured, see `_Stats`.
+        self._stats = None
+        if "stats" in params:
+            if type(params["stats"]) != bt2._BoolValueConst:
+                raise TypeError(
+                    f"PlotSink: expecting `stats` parameter to be a boolean, got a {type(params['stats'])}"
+                )
+
+            if params["stats"]:
+                self._stats = _Stats(self.name)
+                self._instrument(self._stats)
 
         self._add_input_port("in")
 
+    def _instrument(self, stats):
+        get_dispatch = self._get_dispatch
+
+        def _get_dispatch(event):
+            stats.counters[f"events.{event.name}"] += 1
+            return get_dispatch(event)
+
+        self._get_dispatch = _get_dispatch
+        self._render = stats.timed("render", self._render)
+        self._render_live = stats.timed("render-live", self._render_live)
+
+        for plot in self._plots:
+            for logger in plot.get_loggers():
+                stage = f"loggers.{plot.get_title()}.{logger.get_name()}"
+                logger.received_value = stats.timed(stage, logger.received_value)
+
+    def _user_finalize(self):
+        if self._stats is not None:
+            self._stats.dump(self.name)
+
+    @staticmethod
+    def _user_query(query_executor, obj, params, log_level):
+        if obj == "stats":
+            return _Stats.query(params)
+        else:
+            raise bt2.UnknownObject
+
     def _user_consume(self):
-        msg = next(self._iter)
-        if type(msg) in [
-            bt2._PacketBeginningMessageConst,
-            bt2._PacketEndMessageConst,
-            bt2._StreamBeginningMessageConst,
-        ]:
+        # Plots are rendered once, when all the streams have ended.
+        try:
+            msg = next(self._iter)
+        except StopIteration:
+            self._render()
+            raise
+
+        if type(msg) is not bt2._EventMessageConst:
+            # Lets live plots be refreshed even when no events come in.
+            if self._live_interval is not None:
+                self._check_live_interval()
             return
 
-        if type(msg) is bt2._StreamEndMessageConst:
-            {plot.plot() for plot in self._plots}
-            return
+        self._event_count += 1
+        if self._live_events is not None and self._event_count % self._live_events == 0:
+            self._render_live()
+        elif self._live_interval is not None and self._event_count % 1024 == 0:
+            self._check_live_interval()
 
         ts = msg.default_clock_snapshot.value
+        event = msg.event
+        payload_field = event.payload_field
+        for (field, loggers) in self._get_dispatch(event):
+            value = None if field is None else float(payload_field[field])
+            for (logger, index) in loggers:
+                logger.received_value(ts, index, value)
+
+    def _check_live_interval(self):
+        if time.monotonic() - self._live_time >= self._live_interval:
+            self._render_live()
+
+    def _render_live(self):
         for plot in self._plots:
-            plot.received_event(ts, msg.event)
+            plot.plot_live(self._format, self._dpi)
+
+        self._live_time = time.monotonic()
+
+    def _render(self):
+        jobs = min(self._jobs, len(self._plots))
+        if jobs <= 1:
+            for plot in self._plots:
+                plot.plot(self._format, self._dpi)
+            return
+
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_render_worker,
+            initargs=(self._plots,),
+        ) as pool:
+            futures = [
+                pool.submit(_render_worker_plot, index, self._format, self._dpi)
+                for index in range(len(self._plots))
+            ]
+
+            for future in futures:
+                future.result()
+
+    def _get_dispatch(self, event):
+        # Resolve, on the first event of each event class, which loggers want
+        # which of its fields, so that other events only reach the loggers
+        # interested in them and each field is read once.
+        try:
+            return self._dispatch[event.cls.addr]
+        except KeyError:
+            pass
+
+        loggers = [logger for plot in self._plots for logger in plot.get_loggers()]
+        dispatch = get_dispatch(loggers, event)
+        self._dispatch[event.cls.addr] = dispatch
+
+        return dispatch
 
     def _user_graph_is_configured(self):
         self._iter = self._create_message_iterator(self._input_ports["in"])
 
     @staticmethod
-    def create_plot(params):
-        loggers = []
-        for logger in params[3]:
-            if logger[0] == "timed":
-                logger = PlotSink.create_timed_logger(logger)
-            elif logger[0] == "interpolated":
-                logger = PlotSink.create_interpolated_logger(logger)
-            else:
-                raise ValueError
-
-            loggers.append(logger)
+    def create_plot(params, max_points=None):
+        loggers = [PlotSink.create_logger(logger, max_points) for logger in params[3]]
 
         title = str(params[0])
         x_label = str(params[1])
@@ -253,8 +1052,27 @@ class PlotSink(bt2._UserSinkComponent):
         return Plot(loggers, title=title, x_label=x_label, y_label=y_label)
 
     @staticmethod
-    def create_timed_logger(params):
-        return TimedDataLogger((str(params[2]), str(params[3])), name=str(params[1]))
+    def create_logger(params, max_points=None):
+        if params[0] == "timed":
+            return PlotSink.create_timed_logger(params, max_points)
+        elif params[0] == "interpolated":
+            return PlotSink.create_interpolated_logger(params)
+        elif params[0] == "histogram":
+            return PlotSink.create_histogram_logger(params)
+        elif params[0] == "window":
+            return PlotSink.create_window_logger(params)
+        elif params[0] == "rate":
+            return PlotSink.create_rate_logger(params)
+
+        raise ValueError
+
+    @staticmethod
+    def create_timed_logger(params, max_points=None):
+        return TimedDataLogger(
+            (str(params[2]), str(params[3])),
+            name=str(params[1]),
+            max_points=max_points,
+        )
 
     @staticmethod
     def create_interpolated_logger(params):
@@ -264,6 +1082,129 @@ class PlotSink(bt2._UserSinkComponent):
             name=str(params[1]),
         )
 
+    @staticmethod
+    def create_histogram_logger(params):
+        return HistogramDataLogger(
+            (str(params[2]), str(params[3])),
+            float(params[4]),
+            float(params[5]),
+            int(params[6]),
+            name=str(params[1]),
+        )
+
+    @staticmethod
+    def create_window_logger(params):
+        return WindowDataLogger(
+            (str(params[2]), str(params[3])),
+            int(params[4]),
+            str(params[5]),
+            name=str(params[1]),
+        )
+
+    @staticmethod
+    def create_rate_logger(params):
+        return RateDataLogger(str(params[2]), int(params[3]), name=str(params[1]))
+
+
+@bt2.plugin_component_class
+class ExportSink(bt2._UserSinkComponent):
+    """
+        This sink collects the same datasets as `PlotSink`, but writes them
+        to `.npy` files instead of plotting them. The data of `timed` datasets
+        is written in chunks as events are received.
+    """
+
+    # Number of events between two writes of the received data.
+    _CHUNK_EVENTS = 65536
+
+    def __init__(self, config, params, obj):
+        output = "."
+        if "output" in params:
+            output = str(params["output"])
+
+        max_points = None
+        if "max-points" in params:
+            max_points = int(params["max-points"])
+            if max_points < 2:
+                raise ValueError("ExportSink: expecting `max-points` to be at least 2")
+
+        self._loggers = []
+        paths = []
+        for dataset in params["datasets"]:
+            logger = PlotSink.create_logger(dataset, max_points)
+            path = os.path.join(output, Plot._format_filename(logger.get_name(), "npy"))
+            if path in paths:
+                raise ValueError(
+                    f"ExportSink: more than one dataset written to `{path}`"
+                )
+
+            self._loggers.append(logger)
+            paths.append(path)
+
+        os.makedirs(output, exist_ok=True)
+        self._writers = [NpyWriter(path) for path in paths]
+
+        self._event_count = 0
+
+        # Same as `PlotSink._dispatch`.
+        self._dispatch = dict()
+
+        self._add_input_port("in")
+
+    def _user_finalize(self):
+        # Writers are closed once all the data is written, unless the graph
+        # stopped before: the files then hold the data written so far.
+        for writer in self._writers:
+            writer.close()
+
+    def _user_consume(self):
+        try:
+            msg = next(self._iter)
+        except StopIteration:
+            self._write(True)
+            raise
+
+        if type(msg) is not bt2._EventMessageConst:
+            return
+
+        self._event_count += 1
+        if self._event_count % ExportSink._CHUNK_EVENTS == 0:
+            self._write(False)
+
+        ts = msg.default_clock_snapshot.value
+        event = msg.event
+        payload_field = event.payload_field
+        for (field, loggers) in self._get_dispatch(event):
+            value = None if field is None else float(payload_field[field])
+            for (logger, index) in loggers:
+                logger.received_value(ts, index, value)
+
+    def _write(self, end):
+        for (logger, writer) in zip(self._loggers, self._writers):
+            data = logger.pop_data()
+            if data is None and end:
+                data = (logger.get_x_data(), logger.get_y_data())
+
+            if data is not None:
+                writer.write(*data)
+
+            if end:
+                writer.close()
+
+    def _get_dispatch(self, event):
+        try:
+            return self._dispatch[event.cls.addr]
+        except KeyError:
+            pass
+
+        dispatch = get_dispatch(self._loggers, event)
+        self._dispatch[event.cls.addr] = dispatch
+
+        return dispatch
+
+    def _user_graph_is_configured(self):
+        self._iter = self._create_message_iterator(self._input_ports["in"])
+
 
 bt2.register_plugin(
     module_name=__name__,